@@ -0,0 +1,444 @@
+import sys
+import json
+import time
+import resource
+import argparse
+import threading
+import subprocess
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+from tensorflow.keras.layers import Lambda
+from utils import (
+    preprocess,
+    load_box_prior,
+    build_anchor_ops,
+    build_target,
+    yolo_v3,
+    set_precision,
+    build_optimizer,
+    forward_backward,
+    yolo_head,
+    loss_fn,
+    rescale_image,
+    MeanAveragePrecision,
+    build_eval_pool,
+)
+
+train_step = tf.function(forward_backward)
+
+
+def build_bench_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bench", type=str, choices=list(BENCHMARKS))
+    parser.add_argument("--data-dir", type=str, default="D:/won/data")
+    parser.add_argument("--name", type=str, default="voc/2007")
+    parser.add_argument("--img-size", nargs="+", type=int, default=[416, 416])
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--precisions", nargs="+", type=str, default=["float32", "mixed_bfloat16"]
+    )
+    parser.add_argument(
+        "--remats", nargs="+", type=str, default=["none", "block", "stage"]
+    )
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument(
+        "--map-method", type=str, default="coco", choices=["voc07", "voc12", "coco"]
+    )
+
+    return parser.parse_args()
+
+
+def measure_throughput(iterator, steps, batch_size, warmup):
+    for _ in range(warmup):
+        next(iterator)
+    start_time = time.time()
+    for _ in range(steps):
+        next(iterator)
+    elapsed = time.time() - start_time
+
+    return steps * batch_size / elapsed
+
+
+def legacy_preprocess(sample, img_size):
+    image = Lambda(lambda x: x["image"])(sample)
+    gt_boxes = Lambda(lambda x: x["objects"]["bbox"])(sample)
+    gt_labels = Lambda(lambda x: x["objects"]["label"])(sample)
+    transform = tf.keras.Sequential(
+        [
+            tf.keras.layers.experimental.preprocessing.Resizing(
+                img_size[0], img_size[1]
+            ),
+            tf.keras.layers.experimental.preprocessing.Rescaling(1.0 / 255.0),
+        ]
+    )
+    image = transform(image)
+    if tf.random.uniform([1]) > tf.constant([0.5]):
+        image = tf.image.flip_left_right(image)
+        gt_boxes = tf.stack(
+            [
+                Lambda(lambda x: x[..., 0])(gt_boxes),
+                Lambda(lambda x: 1.0 - x[..., 3])(gt_boxes),
+                Lambda(lambda x: x[..., 2])(gt_boxes),
+                Lambda(lambda x: 1.0 - x[..., 1])(gt_boxes),
+            ],
+            -1,
+        )
+    gt_labels = tf.cast(gt_labels, dtype=tf.int32)
+
+    return image, gt_boxes, gt_labels
+
+
+def batch_train_set(dataset, batch_size, target_fn=None):
+    dataset = dataset.repeat().padded_batch(
+        batch_size,
+        padded_shapes=([None, None, None], [None, None], [None]),
+        padding_values=(
+            tf.constant(0, tf.float32),
+            tf.constant(0, tf.float32),
+            tf.constant(-1, tf.int32),
+        ),
+        drop_remainder=True,
+    )
+    if target_fn is not None:
+        dataset = dataset.map(
+            lambda image, gt_boxes, gt_labels: (image, target_fn(gt_boxes, gt_labels)),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        )
+
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def load_train_set(args):
+    raw_set, dataset_info = tfds.load(
+        name=args.name, split="train", data_dir=f"{args.data_dir}/tfds", with_info=True
+    )
+    train_set = raw_set.map(
+        lambda x: preprocess(x, split="train", img_size=args.img_size),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+    )
+    try:
+        labels = dataset_info.features["labels"].names
+    except:
+        labels = dataset_info.features["objects"]["label"].names
+
+    return raw_set, train_set, labels
+
+
+def build_bench_model(args, train_set, labels, precision="float32", remat=None):
+    box_priors = load_box_prior(args.name, args.data_dir, args.img_size)
+    anchors, prior_grids, offset_grids, stride_grids = build_anchor_ops(
+        args.img_size, box_priors
+    )
+    set_precision(precision)
+    model = yolo_v3(args.img_size + [3], labels, args.data_dir, remat=remat)
+    optimizer = build_optimizer(
+        args.batch_size, args.batch_size * args.steps, precision
+    )
+
+    return model, optimizer, (anchors, prior_grids, offset_grids, stride_grids)
+
+
+def bench_input(args):
+    raw_set, parallel_set, _ = load_train_set(args)
+    legacy_set = raw_set.map(lambda x: legacy_preprocess(x, args.img_size))
+
+    results = {}
+    for pipeline, dataset in (("legacy", legacy_set), ("parallel", parallel_set)):
+        iterator = iter(batch_train_set(dataset, args.batch_size))
+        results[pipeline] = measure_throughput(
+            iterator, args.steps, args.batch_size, args.warmup
+        )
+        print(f"{pipeline:>10} | {results[pipeline]:.1f} images/sec")
+    print(f"{'speedup':>10} | {results['parallel'] / results['legacy']:.2f}x")
+
+    return results
+
+
+def measure_step_time(step_fn, iterator, steps, warmup):
+    for _ in range(warmup):
+        step_fn(next(iterator))[0].numpy()
+    start_time = time.time()
+    for _ in range(steps):
+        loss = step_fn(next(iterator))
+    loss[0].numpy()
+
+    return (time.time() - start_time) / steps
+
+
+def bench_target(args):
+    _, train_set, labels = load_train_set(args)
+    model, optimizer, anchor_ops = build_bench_model(args, train_set, labels)
+    anchors, prior_grids, offset_grids, stride_grids = anchor_ops
+    lambda_lst = [tf.constant(1.0)] * 5
+    target_fn = lambda gt_boxes, gt_labels: build_target(
+        anchors, gt_boxes, gt_labels, labels, args.img_size, stride_grids
+    )
+
+    def in_step(batch):
+        image, gt_boxes, gt_labels = batch
+        true = target_fn(gt_boxes, gt_labels)
+        return train_step(
+            image,
+            true,
+            model,
+            optimizer,
+            args.batch_size,
+            lambda_lst,
+            offset_grids,
+            prior_grids,
+        )
+
+    def in_pipeline(batch):
+        image, true = batch
+        return train_step(
+            image,
+            true,
+            model,
+            optimizer,
+            args.batch_size,
+            lambda_lst,
+            offset_grids,
+            prior_grids,
+        )
+
+    results = {}
+    for mode, step_fn, dataset in (
+        ("in_step", in_step, batch_train_set(train_set, args.batch_size)),
+        (
+            "pipeline",
+            in_pipeline,
+            batch_train_set(train_set, args.batch_size, target_fn),
+        ),
+    ):
+        results[mode] = measure_step_time(
+            step_fn, iter(dataset), args.steps, args.warmup
+        )
+        print(f"{mode:>10} | {results[mode] * 1000:.1f} ms/step")
+    print(f"{'speedup':>10} | {results['in_step'] / results['pipeline']:.2f}x")
+
+    return results
+
+
+def bench_precision(args):
+    _, train_set, labels = load_train_set(args)
+    lambda_lst = [tf.constant(1.0)] * 5
+
+    results = {}
+    for precision in args.precisions:
+        tf.keras.backend.clear_session()
+        tf.random.set_seed(args.seed)
+        model, optimizer, anchor_ops = build_bench_model(
+            args, train_set, labels, precision
+        )
+        anchors, prior_grids, offset_grids, stride_grids = anchor_ops
+        target_fn = lambda gt_boxes, gt_labels: build_target(
+            anchors, gt_boxes, gt_labels, labels, args.img_size, stride_grids
+        )
+
+        def step_fn(batch):
+            image, true = batch
+            return train_step(
+                image,
+                true,
+                model,
+                optimizer,
+                args.batch_size,
+                lambda_lst,
+                offset_grids,
+                prior_grids,
+            )
+
+        iterator = iter(batch_train_set(train_set, args.batch_size, target_fn))
+        eval_image, eval_true = next(iterator)
+        step_time = measure_step_time(step_fn, iterator, args.steps, args.warmup)
+        pred = yolo_head(model(rescale_image(eval_image)), offset_grids, prior_grids)
+        eval_loss = tf.reduce_sum(
+            loss_fn(pred, eval_true, args.batch_size, lambda_lst)
+        ).numpy()
+        results[precision] = (step_time, eval_loss)
+        print(
+            f"{precision:>15} | {step_time * 1000:.1f} ms/step | "
+            f"{args.batch_size / step_time:.1f} images/sec | "
+            f"loss after {args.warmup + args.steps} steps {eval_loss:.4f}"
+        )
+    set_precision("float32")
+
+    return results
+
+
+def measure_step_memory(step_fn, iterator, steps, warmup):
+    if not tf.config.list_physical_devices("GPU"):
+        step_time = measure_step_time(step_fn, iterator, steps, warmup)
+        return step_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    # tensorflow 2.4 only reports the current allocation, so poll it during the steps
+    peak_memory = [0]
+    stop = threading.Event()
+
+    def poll():
+        while not stop.is_set():
+            usage = tf.config.experimental.get_memory_usage("GPU:0")
+            peak_memory[0] = max(peak_memory[0], usage)
+            time.sleep(1e-3)
+
+    thread = threading.Thread(target=poll, daemon=True)
+    thread.start()
+    step_time = measure_step_time(step_fn, iterator, steps, warmup)
+    stop.set()
+    thread.join()
+
+    return step_time, peak_memory[0] / 2**20
+
+
+def bench_remat(args):
+    if len(args.remats) == 1:
+        return run_remat(args, args.remats[0])
+
+    results = {}
+    for remat in args.remats:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "remat",
+                "--remats",
+                remat,
+                "--data-dir",
+                args.data_dir,
+                "--name",
+                args.name,
+                "--img-size",
+                *map(str, args.img_size),
+                "--batch-size",
+                str(args.batch_size),
+                "--steps",
+                str(args.steps),
+                "--warmup",
+                str(args.warmup),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results[remat] = tuple(json.loads(output.splitlines()[-1]))
+        step_time, peak_memory = results[remat]
+        print(
+            f"{remat:>10} | {step_time * 1000:.1f} ms/step | "
+            f"peak {peak_memory:.0f} MiB"
+        )
+
+    return results
+
+
+def run_remat(args, remat):
+    _, train_set, labels = load_train_set(args)
+    lambda_lst = [tf.constant(1.0)] * 5
+    model, optimizer, anchor_ops = build_bench_model(
+        args, train_set, labels, remat=None if remat == "none" else remat
+    )
+    anchors, prior_grids, offset_grids, stride_grids = anchor_ops
+    target_fn = lambda gt_boxes, gt_labels: build_target(
+        anchors, gt_boxes, gt_labels, labels, args.img_size, stride_grids
+    )
+
+    def step_fn(batch):
+        image, true = batch
+        return train_step(
+            image,
+            true,
+            model,
+            optimizer,
+            args.batch_size,
+            lambda_lst,
+            offset_grids,
+            prior_grids,
+        )
+
+    iterator = iter(batch_train_set(train_set, args.batch_size, target_fn))
+    step_time, peak_memory = measure_step_memory(
+        step_fn, iterator, args.steps, args.warmup
+    )
+    print(f"{remat:>10} | {step_time * 1000:.1f} ms/step | peak {peak_memory:.0f} MiB")
+    print(json.dumps([step_time, peak_memory]))
+
+    return step_time, peak_memory
+
+
+def build_map_batches(steps, batch_size, labels_num=20, seed=0):
+    rng = np.random.default_rng(seed)
+    batches = []
+    for _ in range(steps):
+        gt_hw = rng.uniform(0.02, 0.5, size=(batch_size, 20, 2))
+        gt_yx = rng.uniform(0.0, 1.0 - gt_hw)
+        gt_boxes = np.concatenate([gt_yx, gt_yx + gt_hw], axis=-1)
+        gt_labels = rng.integers(0, labels_num, size=(batch_size, 20))
+        jitter = rng.normal(0.0, 0.05, size=(batch_size, 200, 4))
+        final_bboxes = np.clip(np.tile(gt_boxes, (1, 10, 1)) + jitter, 0.0, 1.0)
+        final_labels = np.tile(gt_labels, (1, 10))
+        final_scores = rng.uniform(size=(batch_size, 200))
+        batches.append(
+            (
+                (
+                    final_bboxes.astype(np.float32),
+                    final_labels,
+                    final_scores.astype(np.float32),
+                    np.full(batch_size, 200),
+                ),
+                (gt_boxes.astype(np.float32), gt_labels),
+                np.tile([[480, 640]], (batch_size, 1)),
+                (gt_hw[..., 0] * gt_hw[..., 1] * 480 * 640).astype(np.float32),
+            )
+        )
+
+    return batches
+
+
+def measure_map_time(batches, method, pool):
+    metric = MeanAveragePrecision(20, method, pool)
+    start_time = time.time()
+    for batch in batches:
+        metric.update_batch(*batch)
+    metric.result()
+
+    return time.time() - start_time
+
+
+def bench_map(args):
+    batches = build_map_batches(args.steps, args.batch_size)
+    results = {}
+    for workers in args.workers:
+        pool = build_eval_pool(workers)
+        if pool is not None:
+            list(pool.map(time.sleep, [0.1] * workers))
+        measure_map_time(batches[: args.warmup], args.map_method, pool)
+        results[workers] = measure_map_time(batches, args.map_method, pool)
+        if pool is not None:
+            pool.shutdown()
+        print(
+            f"{workers:>10} | {results[workers]:.2f} s | "
+            f"{args.steps * args.batch_size / results[workers]:.1f} images/sec"
+        )
+
+    return results
+
+
+BENCHMARKS = {
+    "input": bench_input,
+    "target": bench_target,
+    "precision": bench_precision,
+    "remat": bench_remat,
+    "map": bench_map,
+}
+
+
+def main():
+    args = build_bench_args()
+    BENCHMARKS[args.bench](args)
+
+
+if __name__ == "__main__":
+    main()
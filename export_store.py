@@ -0,0 +1,17 @@
+import os
+from utils import build_args, load_dataset
+
+
+def main():
+    args = build_args()
+    os.makedirs(f"{args.data_dir}/data_chkr", exist_ok=True)
+    load_dataset(
+        name=args.name,
+        data_dir=args.data_dir,
+        img_size=args.img_size,
+        image_store=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import os
+import sys
+import argparse
+import subprocess
+from utils import build_tf_config
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--base-port", type=int, default=12345)
+    args, main_args = parser.parse_known_args()
+
+    main_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    processes = []
+    for task_id in range(args.num_workers):
+        env = dict(
+            os.environ,
+            TF_CONFIG=build_tf_config(
+                args.num_workers, task_id, base_port=args.base_port
+            ),
+            CUDA_VISIBLE_DEVICES="",
+        )
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, main_dir, "--multi-worker", *main_args], env=env
+            )
+        )
+
+    sys.exit(max(process.wait() for process in processes))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,45 @@
-import tensorflow as tf
 from utils import (
+    build_args,
+    build_strategy,
+    is_chief,
+    sync_workers,
     initialize_process,
     load_dataset,
-    build_dataset,
     run_process,
+    run_evaluator,
     NEPTUNE_API_KEY,
     NEPTUNE_PROJECT,
 )
 
 
 def main():
-    args, run, weights_dir = initialize_process(
-        NEPTUNE_API_KEY, NEPTUNE_PROJECT
+    args = build_args()
+    if args.evaluator:
+        datasets, labels, train_num, valid_num, test_num = load_dataset(
+            name=args.name,
+            data_dir=args.data_dir,
+            img_size=args.img_size,
+            image_store=args.image_store,
+        )
+        run_evaluator(
+            NEPTUNE_API_KEY, NEPTUNE_PROJECT, args, labels, valid_num, datasets
+        )
+        return
+
+    strategy = build_strategy(args.multi_worker)
+    run, weights_dir = initialize_process(
+        NEPTUNE_API_KEY, NEPTUNE_PROJECT, args, strategy
     )
 
+    if not is_chief(strategy):
+        sync_workers(strategy)
     datasets, labels, train_num, valid_num, test_num = load_dataset(
-        name=args.name, data_dir=args.data_dir
-    )
-    train_set, valid_set, test_set = build_dataset(
-        datasets, args.batch_size, args.img_size, strategy
+        name=args.name,
+        data_dir=args.data_dir,
+        img_size=args.img_size,
+        image_store=args.image_store,
     )
 
-    strategy = tf.distribute.MirroredStrategy()
     run_process(
         args,
         labels,
@@ -29,9 +47,7 @@ def main():
         valid_num,
         test_num,
         run,
-        train_set,
-        valid_set,
-        test_set,
+        datasets,
         weights_dir,
         strategy,
     )
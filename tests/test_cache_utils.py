@@ -0,0 +1,126 @@
+import numpy as np
+import tensorflow as tf
+from utils.anchor_utils import build_anchor_ops
+from utils.bbox_utils import calculate_iou
+from utils.cache_utils import write_target_cache, read_target_cache
+from utils.target_utils import build_target
+
+IMG_SIZE = [64, 64]
+LABELS = ["a", "b", "c"]
+BOX_PRIORS = tf.constant(
+    [
+        [6, 8],
+        [10, 12],
+        [14, 10],
+        [18, 24],
+        [26, 20],
+        [30, 36],
+        [40, 32],
+        [48, 52],
+        [60, 56],
+    ],
+    dtype=tf.float32,
+)
+GT_BOXES = np.array(
+    [[0.1, 0.05, 0.5, 0.4], [0.3, 0.55, 0.9, 0.95], [0.6, 0.1, 0.7, 0.22]],
+    dtype=np.float32,
+)
+GT_LABELS = np.array([0, 2, 1], dtype=np.int64)
+
+
+def build_sample():
+    image = np.zeros(IMG_SIZE + [3], dtype=np.uint8)
+    image[:, : IMG_SIZE[1] // 4] = 255
+
+    return {
+        "image": image,
+        "objects": {
+            "bbox": GT_BOXES,
+            "label": GT_LABELS,
+            "is_difficult": np.zeros(len(GT_LABELS), dtype=bool),
+        },
+    }
+
+
+def assert_same_targets(cached, expected, iou_map):
+    cached = [target.numpy() for target in cached]
+    expected = [target[0].numpy() for target in expected]
+    cached_pos = set(np.flatnonzero(cached[2][:, 0]))
+    expected_pos = set(np.flatnonzero(expected[2][:, 0]))
+    assert len(cached_pos) == len(expected_pos)
+
+    # argmax ties between anchors may pick a different, equally good anchor
+    best_iou = iou_map.max(axis=0)
+    for anchor in cached_pos ^ expected_pos:
+        assert np.isclose(iou_map[anchor], best_iou, atol=1e-6).any()
+    for anchor in cached_pos & expected_pos:
+        for cached_target, expected_target in zip(cached, expected):
+            np.testing.assert_allclose(
+                cached_target[anchor], expected_target[anchor], atol=1e-5
+            )
+    negatives = np.ones(len(cached[3]), dtype=bool)
+    negatives[list(cached_pos | expected_pos)] = False
+    np.testing.assert_array_equal(cached[3][negatives], expected[3][negatives])
+
+
+def test_target_cache_round_trip(tmp_path):
+    anchors, _, _, stride_grids = build_anchor_ops(IMG_SIZE, BOX_PRIORS)
+    sample = build_sample()
+    dataset = tf.data.Dataset.from_tensors(sample)
+    cache_dir = str(tmp_path / "cache")
+    write_target_cache(
+        dataset, cache_dir, IMG_SIZE, anchors, stride_grids, LABELS, 0.5, 1
+    )
+    cache_set = read_target_cache(
+        cache_dir, IMG_SIZE, stride_grids, LABELS, deterministic=True
+    )
+
+    flipped_boxes = np.stack(
+        [GT_BOXES[:, 0], 1.0 - GT_BOXES[:, 3], GT_BOXES[:, 2], 1.0 - GT_BOXES[:, 1]],
+        axis=-1,
+    )
+    seen = set()
+    for image, true in cache_set.take(32):
+        flipped = image.numpy()[0, -1, 0] == 255
+        gt_boxes = flipped_boxes if flipped else GT_BOXES
+        expected = build_target(
+            anchors,
+            gt_boxes[None],
+            GT_LABELS[None].astype(np.int32),
+            LABELS,
+            IMG_SIZE,
+            stride_grids,
+        )
+        iou_map = calculate_iou(anchors, gt_boxes[None])[0].numpy()
+        assert_same_targets(true, expected, iou_map)
+        seen.add(flipped)
+
+    assert seen == {False, True}
+
+
+def test_resumed_cache_replays_flips(tmp_path):
+    anchors, _, _, stride_grids = build_anchor_ops(IMG_SIZE, BOX_PRIORS)
+    dataset = tf.data.Dataset.from_tensors(build_sample()).repeat(3)
+    cache_dir = str(tmp_path / "cache")
+    write_target_cache(
+        dataset, cache_dir, IMG_SIZE, anchors, stride_grids, LABELS, 0.5, 2
+    )
+
+    def take_flips(skip_samples, sample_num):
+        cache_set = read_target_cache(
+            cache_dir,
+            IMG_SIZE,
+            stride_grids,
+            LABELS,
+            skip_samples=skip_samples % 3,
+            deterministic=True,
+            seed=5,
+            start_index=skip_samples,
+        )
+        return [
+            image.numpy()[0, -1, 0] == 255 for image, _ in cache_set.take(sample_num)
+        ]
+
+    full_run = take_flips(0, 24)
+
+    assert take_flips(7, 17) == full_run[7:]
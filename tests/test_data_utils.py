@@ -0,0 +1,86 @@
+import numpy as np
+import tensorflow as tf
+from utils.data_utils import build_dataset, mosaic_batch
+
+IMG_SIZE = [32, 32]
+
+
+def build_datasets(data_num=10):
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, size=(data_num, 40, 48, 3), dtype=np.uint8)
+    boxes = np.tile([[[0.1, 0.2, 0.6, 0.7], [0.3, 0.1, 0.9, 0.5]]], (data_num, 1, 1))
+    labels = rng.integers(0, 3, size=(data_num, 2))
+    dataset = tf.data.Dataset.from_tensor_slices(
+        {
+            "image": images,
+            "objects": {
+                "bbox": boxes.astype(np.float32),
+                "label": labels,
+                "is_difficult": np.zeros((data_num, 2), dtype=bool),
+            },
+        }
+    )
+
+    return dataset, dataset.take(2), dataset.take(2)
+
+
+def take_batches(start_step, batch_num, batch_size=2, data_num=10):
+    skip_samples = start_step * batch_size
+    train_set, _, _ = build_dataset(
+        build_datasets(data_num),
+        batch_size,
+        IMG_SIZE,
+        mosaic_prob=0.5,
+        mixup_prob=0.5,
+        skip_samples=skip_samples % data_num,
+        deterministic=True,
+        seed=3,
+        start_index=skip_samples,
+    )
+
+    return [
+        [component.numpy() for component in batch]
+        for batch in train_set.take(batch_num)
+    ]
+
+
+def test_resumed_pipeline_replays_batches_and_augmentation():
+    full_run = take_batches(0, 12)
+    for start_step in (2, 7):
+        resumed = take_batches(start_step, 12 - start_step)
+        for expected, batch in zip(full_run[start_step:], resumed):
+            for expected_component, component in zip(expected, batch):
+                np.testing.assert_array_equal(component, expected_component)
+
+
+def test_pipeline_augmentation_changes_across_epochs():
+    batches = take_batches(0, 10)
+
+    assert any(not np.array_equal(batches[i][0], batches[i + 5][0]) for i in range(5))
+
+
+def test_mosaic_keeps_box_aspect_ratio():
+    gt_boxes = np.tile([[[0.3, 0.4, 0.7, 0.6]]], (4, 1, 1)).astype(np.float32)
+    image = np.zeros([4, 64, 64, 3], dtype=np.float32)
+    uncropped_num = 0
+    for i in range(20):
+        seed = tf.constant([i, 0], dtype=tf.int64)
+        _, boxes, labels = mosaic_batch(
+            image, gt_boxes, np.zeros([4, 1], dtype=np.int32), [64, 64], seed=seed
+        )
+        center = tf.random.stateless_uniform([2], seed, 0.25, 0.75).numpy()
+        edges = np.floor(center * 64) / 64
+        boxes = boxes.numpy()[labels.numpy() >= 0]
+        cropped = (
+            np.isclose(boxes[:, [0, 2]], edges[0]).any(axis=-1)
+            | np.isclose(boxes[:, [1, 3]], edges[1]).any(axis=-1)
+            | np.isclose(boxes, 0.0).any(axis=-1)
+            | np.isclose(boxes, 1.0).any(axis=-1)
+        )
+        box_h = boxes[:, 2] - boxes[:, 0]
+        box_w = boxes[:, 3] - boxes[:, 1]
+        ratio = box_h[~cropped] / box_w[~cropped]
+        uncropped_num += len(ratio)
+
+        np.testing.assert_allclose(ratio, 2.0, rtol=0.1)
+    assert uncropped_num > 0
@@ -0,0 +1,65 @@
+import numpy as np
+import tensorflow as tf
+from utils.anchor_utils import build_anchor_ops
+from utils.model_utils import DarkNet53, yolo_v3, yolo_head
+from utils.opt_utils import set_precision, build_optimizer, forward_backward
+from utils.target_utils import build_target
+
+IMG_SIZE = [64, 64]
+LABELS = ["a", "b", "c"]
+BOX_PRIORS = tf.constant(
+    [
+        [6, 8],
+        [10, 12],
+        [14, 10],
+        [18, 24],
+        [26, 20],
+        [30, 36],
+        [40, 32],
+        [48, 52],
+        [60, 56],
+    ],
+    dtype=tf.float32,
+)
+
+
+def test_mixed_bfloat16_train_step_on_cpu(tmp_path):
+    data_dir = str(tmp_path)
+    set_precision("float32")
+    DarkNet53(include_top=False, input_shape=IMG_SIZE + [3]).save_weights(
+        f"{data_dir}/darknet_weights/weights"
+    )
+    set_precision("mixed_bfloat16")
+    try:
+        with tf.device("/cpu:0"):
+            model = yolo_v3(IMG_SIZE + [3], LABELS, data_dir)
+            optimizer = build_optimizer(2, 100, "mixed_bfloat16")
+            anchors, prior_grids, offset_grids, stride_grids = build_anchor_ops(
+                IMG_SIZE, BOX_PRIORS
+            )
+            image = tf.random.uniform([2] + IMG_SIZE + [3])
+            true = build_target(
+                anchors,
+                tf.constant([[[0.1, 0.1, 0.6, 0.5]], [[0.3, 0.4, 0.9, 0.8]]]),
+                tf.constant([[0], [2]]),
+                LABELS,
+                IMG_SIZE,
+                stride_grids,
+            )
+            pred = yolo_head(model(image), offset_grids, prior_grids)
+            loss = tf.function(forward_backward)(
+                image,
+                true,
+                model,
+                optimizer,
+                2,
+                [tf.constant(1.0)] * 5,
+                offset_grids,
+                prior_grids,
+            )
+    finally:
+        set_precision("float32")
+
+    assert model.layers[1].compute_dtype == "bfloat16"
+    assert all(output.dtype == tf.float32 for output in pred)
+    assert all(np.isfinite(loss_value.numpy()) for loss_value in loss)
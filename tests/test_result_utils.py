@@ -0,0 +1,308 @@
+import contextlib
+import io
+import numpy as np
+import pytest
+import tensorflow as tf
+from utils.bbox_utils import calculate_iou
+from utils.result_utils import (
+    MeanAveragePrecision,
+    MetricConsumer,
+    build_eval_pool,
+    calculate_ap_per_class,
+    calculate_iou_matrix,
+    calculate_pr,
+    match_best_gt,
+)
+
+
+def baseline_calculate_pr(final_bbox, gt_box, mAP_threshold):
+    bbox_num = tf.shape(final_bbox)[1].numpy()
+    gt_num = tf.shape(gt_box)[1].numpy()
+
+    true_pos = tf.Variable(tf.zeros(bbox_num))
+    for i in range(bbox_num):
+        bbox = tf.split(final_bbox, bbox_num, axis=1)[i]
+
+        iou = calculate_iou(bbox, gt_box)
+
+        best_iou = tf.reduce_max(iou, axis=1)
+        pos_num = tf.cast(tf.greater(best_iou, mAP_threshold), dtype=tf.float32)
+        if tf.reduce_sum(pos_num) >= 1:
+            gt_box = gt_box * tf.expand_dims(
+                tf.cast(1 - pos_num, dtype=tf.float32), axis=-1
+            )
+            true_pos = tf.tensor_scatter_nd_update(true_pos, [[i]], [1])
+    false_pos = 1.0 - true_pos
+    true_pos = tf.math.cumsum(true_pos)
+    false_pos = tf.math.cumsum(false_pos)
+
+    recall = true_pos / gt_num
+    precision = tf.math.divide(true_pos, true_pos + false_pos)
+
+    return precision, recall
+
+
+def baseline_calculate_ap_per_class(recall, precision):
+    if len(recall) == 0:
+        return tf.constant(0.0)
+    interp = tf.constant([i / 10 for i in range(0, 11)])
+    AP = tf.reduce_max(
+        [tf.where(interp <= recall[i], precision[i], 0.0) for i in range(len(recall))],
+        axis=0,
+    )
+    AP = tf.reduce_sum(AP) / 11
+
+    return AP
+
+
+PR_CASES = {
+    "empty": ([], []),
+    "single": ([0.5], [1.0]),
+    "recall_below_one": ([0.1, 0.3, 0.3, 0.6], [1.0, 0.75, 0.6, 0.5]),
+    "recall_on_points": (
+        [0.2, 0.4, 0.4, 0.6, 0.8, 1.0],
+        [1.0, 1.0, 0.5, 0.6, 0.4, 0.5],
+    ),
+    "tied_precision": ([0.25, 0.5, 0.5, 0.75, 1.0], [0.5, 0.5, 0.5, 0.5, 0.5]),
+    "zero_precision": ([0.0, 0.0, 0.5], [0.0, 0.0, 1.0 / 3.0]),
+}
+
+
+@pytest.mark.parametrize("case", PR_CASES)
+def test_11point_ap_matches_baseline(case):
+    recall, precision = [np.asarray(x, dtype=np.float32) for x in PR_CASES[case]]
+    expected = baseline_calculate_ap_per_class(recall, precision).numpy()
+
+    assert calculate_ap_per_class(recall, precision) == pytest.approx(
+        expected, rel=1e-6, abs=1e-7
+    )
+
+
+def test_11point_ap_matches_baseline_on_random_pr():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        true_pos = rng.uniform(size=rng.integers(1, 40)) < 0.5
+        gt_num = true_pos.sum() + rng.integers(0, 5) or 1
+        precision, recall = calculate_pr(true_pos, ~true_pos, gt_num)
+        expected = baseline_calculate_ap_per_class(recall, precision).numpy()
+
+        assert calculate_ap_per_class(recall, precision) == pytest.approx(
+            expected, rel=1e-6, abs=1e-7
+        )
+
+
+BOX_CASES = {
+    "empty": (np.zeros((0, 4)), [[0.1, 0.1, 0.4, 0.4]]),
+    "no_gt_matched": ([[0.6, 0.6, 0.9, 0.9]], [[0.1, 0.1, 0.4, 0.4]]),
+    "recall_below_one": (
+        [[0.1, 0.1, 0.4, 0.4], [0.6, 0.6, 0.9, 0.9], [0.12, 0.1, 0.4, 0.42]],
+        [[0.1, 0.1, 0.4, 0.4], [0.5, 0.0, 0.9, 0.3]],
+    ),
+    "duplicates": (
+        [
+            [0.1, 0.1, 0.4, 0.4],
+            [0.1, 0.1, 0.4, 0.4],
+            [0.5, 0.5, 0.8, 0.8],
+            [0.51, 0.5, 0.8, 0.8],
+        ],
+        [[0.1, 0.1, 0.4, 0.4], [0.5, 0.5, 0.8, 0.8]],
+    ),
+    "iou_on_threshold": (
+        [[0.0, 0.0, 0.5, 0.5], [0.0, 0.0, 0.25, 1.0]],
+        [[0.0, 0.0, 0.5, 1.0]],
+    ),
+}
+
+
+@pytest.mark.parametrize("case", BOX_CASES)
+def test_pr_matches_baseline(case):
+    final_bbox, gt_box = [np.asarray(x, dtype=np.float32) for x in BOX_CASES[case]]
+    expected_precision, expected_recall = baseline_calculate_pr(
+        final_bbox[None], gt_box[None], 0.5
+    )
+    true_pos = match_best_gt(calculate_iou_matrix(final_bbox, gt_box), [0.5])[0]
+    precision, recall = calculate_pr(true_pos, ~true_pos, len(gt_box))
+
+    np.testing.assert_array_equal(precision, expected_precision.numpy())
+    np.testing.assert_array_equal(recall, expected_recall.numpy())
+
+
+def test_detection_over_several_gts_takes_only_the_best():
+    final_bbox = np.array([[0.0, 0.0, 1.0, 0.9], [0.0, 0.0, 1.0, 0.8]], np.float32)
+    gt_box = np.array([[0.0, 0.0, 1.0, 1.0], [0.0, 0.0, 1.0, 0.8]], np.float32)
+    true_pos = match_best_gt(calculate_iou_matrix(final_bbox, gt_box), [0.5])[0]
+    precision, recall = calculate_pr(true_pos, ~true_pos, len(gt_box))
+
+    np.testing.assert_array_equal(true_pos, [True, True])
+    np.testing.assert_allclose(recall, [0.5, 1.0])
+    np.testing.assert_allclose(precision, [1.0, 1.0])
+
+    # the old loop let the first detection consume both gts
+    _, baseline_recall = baseline_calculate_pr(final_bbox[None], gt_box[None], 0.5)
+    np.testing.assert_allclose(baseline_recall.numpy(), [0.5, 0.5])
+
+
+def build_fixture(seed=0, image_num=24, labels_num=3):
+    rng = np.random.default_rng(seed)
+    scores = iter(rng.permutation(np.linspace(0.01, 0.99, 20000)))
+    samples = []
+    for _ in range(image_num):
+        image_shape = rng.integers(200, 800, size=2)
+        gt_num = rng.integers(0, 12)
+        gt_hw = rng.uniform(0.03, 0.6, size=(gt_num, 2))
+        gt_yx = rng.uniform(0.0, 1.0 - gt_hw)
+        gt_boxes = np.concatenate([gt_yx, gt_yx + gt_hw], axis=-1).astype(np.float32)
+        gt_labels = rng.integers(0, labels_num, size=gt_num)
+        gt_areas = (
+            gt_hw[:, 0] * gt_hw[:, 1] * np.prod(image_shape) * rng.uniform(0.5, 1.0)
+        ).astype(np.float32)
+
+        jitter = rng.normal(0.0, 0.05, size=(gt_num, 4)) * np.tile(gt_hw, 2)
+        false_num = rng.integers(0, 120 if rng.uniform() < 0.2 else 8)
+        false_hw = rng.uniform(0.02, 0.5, size=(false_num, 2))
+        false_yx = rng.uniform(0.0, 1.0 - false_hw)
+        final_bboxes = np.concatenate(
+            [
+                gt_boxes + jitter,
+                np.concatenate([false_yx, false_yx + false_hw], axis=-1),
+            ]
+        )
+        final_bboxes = np.clip(final_bboxes, 0.0, 1.0).astype(np.float32)
+        final_labels = np.concatenate(
+            [
+                np.where(
+                    rng.uniform(size=gt_num) < 0.9,
+                    gt_labels,
+                    rng.integers(0, labels_num, size=gt_num),
+                ),
+                rng.integers(0, labels_num, size=false_num),
+            ]
+        )
+        final_scores = np.array(
+            [next(scores) for _ in range(len(final_labels))], dtype=np.float32
+        )
+        samples.append(
+            (
+                (final_bboxes, final_labels, final_scores),
+                (gt_boxes, gt_labels),
+                image_shape,
+                gt_areas,
+            )
+        )
+
+    return samples
+
+
+def to_coco_box(box, image_shape):
+    y1, x1, y2, x2 = box.astype(np.float64)
+    height, width = image_shape
+
+    return [x1 * width, y1 * height, (x2 - x1) * width, (y2 - y1) * height]
+
+
+def evaluate_pycocotools(samples, labels_num):
+    coco = pytest.importorskip("pycocotools.coco")
+    cocoeval = pytest.importorskip("pycocotools.cocoeval")
+    images, annotations, results = [], [], []
+    for image_id, (detections, ground_truth, image_shape, gt_areas) in enumerate(
+        samples, 1
+    ):
+        images.append(
+            {
+                "id": image_id,
+                "height": int(image_shape[0]),
+                "width": int(image_shape[1]),
+            }
+        )
+        for box, label, area in zip(*ground_truth, gt_areas):
+            annotations.append(
+                {
+                    "id": len(annotations) + 1,
+                    "image_id": image_id,
+                    "category_id": int(label) + 1,
+                    "bbox": to_coco_box(box, image_shape),
+                    "area": float(area),
+                    "iscrowd": 0,
+                }
+            )
+        for box, label, score in zip(*detections):
+            results.append(
+                {
+                    "image_id": image_id,
+                    "category_id": int(label) + 1,
+                    "bbox": to_coco_box(box, image_shape),
+                    "score": float(score),
+                }
+            )
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        gt = coco.COCO()
+        gt.dataset = {
+            "images": images,
+            "annotations": annotations,
+            "categories": [{"id": c + 1} for c in range(labels_num)],
+        }
+        gt.createIndex()
+        evaluator = cocoeval.COCOeval(gt, gt.loadRes(results), "bbox")
+        evaluator.evaluate()
+        evaluator.accumulate()
+        evaluator.summarize()
+
+    return evaluator.stats
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_coco_map_matches_pycocotools(seed):
+    samples = build_fixture(seed)
+    metric = MeanAveragePrecision(3, "coco")
+    for sample in samples:
+        metric.update(*sample)
+    aps = metric.result()
+    stats = evaluate_pycocotools(samples, 3)
+
+    assert aps["all"] == pytest.approx(stats[0], abs=1e-9)
+    assert aps["small"] == pytest.approx(stats[3], abs=1e-9)
+    assert aps["medium"] == pytest.approx(stats[4], abs=1e-9)
+    assert aps["large"] == pytest.approx(stats[5], abs=1e-9)
+
+
+def test_coco_map_without_areas_reports_all_only():
+    samples = build_fixture()
+    metric = MeanAveragePrecision(3, "coco")
+    for detections, ground_truth, _, _ in samples:
+        metric.update(detections, ground_truth)
+
+    assert list(metric.result()) == ["all"]
+
+
+def test_pooled_map_matches_serial():
+    samples = build_fixture()
+    pool = build_eval_pool(2)
+    serial, pooled = [
+        MeanAveragePrecision(3, "coco", pool=metric_pool, chunk_size=4)
+        for metric_pool in (None, pool)
+    ]
+    for sample in samples:
+        serial.update(*sample)
+        pooled.update(*sample)
+    try:
+        assert pooled.result() == serial.result()
+    finally:
+        pool.shutdown()
+
+
+class FailingMetric:
+    def update_batch(self, *args):
+        raise ValueError("broken batch")
+
+    def result(self):
+        return {"all": 0.0}
+
+
+def test_metric_consumer_reraises_update_errors():
+    metric = MetricConsumer(FailingMetric(), maxsize=2)
+    with pytest.raises(ValueError, match="broken batch"):
+        for _ in range(100):
+            metric.update_batch(None)
+    with pytest.raises(ValueError, match="broken batch"):
+        metric.result()
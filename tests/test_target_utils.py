@@ -0,0 +1,72 @@
+import numpy as np
+import tensorflow as tf
+from utils.anchor_utils import build_anchor_ops
+from utils.data_utils import build_iterator
+from utils.target_utils import build_target
+
+IMG_SIZE = [64, 64]
+LABELS = ["a", "b", "c"]
+BOX_PRIORS = tf.constant(
+    [
+        [6, 8],
+        [10, 12],
+        [14, 10],
+        [18, 24],
+        [26, 20],
+        [30, 36],
+        [40, 32],
+        [48, 52],
+        [60, 56],
+    ],
+    dtype=tf.float32,
+)
+
+
+def build_batch():
+    gt_boxes = tf.constant(
+        [
+            [[0.1, 0.1, 0.5, 0.4], [0.3, 0.5, 0.9, 0.9], [0.0, 0.0, 0.0, 0.0]],
+            [[0.2, 0.2, 0.3, 0.35], [0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0]],
+        ],
+        dtype=tf.float32,
+    )
+    gt_labels = tf.constant([[0, 2, -1], [1, -1, -1]], dtype=tf.int32)
+
+    return gt_boxes, gt_labels
+
+
+def encode(anchors, stride_grids, gt_boxes, gt_labels):
+    return build_target(anchors, gt_boxes, gt_labels, LABELS, IMG_SIZE, stride_grids)
+
+
+def test_build_target_traced_matches_eager():
+    anchors, _, _, stride_grids = build_anchor_ops(IMG_SIZE, BOX_PRIORS)
+    gt_boxes, gt_labels = build_batch()
+    eager = encode(anchors, stride_grids, gt_boxes, gt_labels)
+    traced = tf.function(encode)(anchors, stride_grids, gt_boxes, gt_labels)
+
+    for eager_target, traced_target in zip(eager, traced):
+        np.testing.assert_array_equal(traced_target.numpy(), eager_target.numpy())
+    assert np.sum(eager[2].numpy()) == 3
+
+
+def test_pipeline_targets_match_eager():
+    anchors, _, _, stride_grids = build_anchor_ops(IMG_SIZE, BOX_PRIORS)
+    gt_boxes, gt_labels = build_batch()
+    image = tf.zeros([2] + IMG_SIZE + [3])
+    dataset_fn = lambda input_context: tf.data.Dataset.from_tensors(
+        (image, gt_boxes, gt_labels)
+    ).repeat()
+    target_fn = lambda gt_boxes, gt_labels: encode(
+        anchors, stride_grids, gt_boxes, gt_labels
+    )
+    train_set, _, _ = build_iterator(
+        (dataset_fn, tf.data.Dataset.range(1), tf.data.Dataset.range(1)),
+        tf.distribute.get_strategy(),
+        target_fn,
+    )
+    _, pipeline = next(train_set)
+    eager = encode(anchors, stride_grids, gt_boxes, gt_labels)
+
+    for eager_target, pipeline_target in zip(eager, pipeline):
+        np.testing.assert_array_equal(pipeline_target.numpy(), eager_target.numpy())
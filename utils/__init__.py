@@ -1,19 +1,38 @@
 from .data_utils import (
     build_dataset,
+    build_iterator,
     load_dataset,
     export_data,
     resize_and_rescale,
+    rescale_image,
+    export_eval_info,
+    build_sample_seed,
+    draw_uniform,
     evaluate,
     rand_flip_horiz,
     preprocess,
+    augment_batch,
+    mosaic_batch,
+    mixup_batch,
+    clip_batch_boxes,
+)
+
+from .store_utils import (
+    load_image_store,
+    build_image_store,
+    read_image_store,
 )
 
 from .anchor_utils import (
     load_box_prior,
     build_box_prior,
     k_means,
+    init_centers,
+    assign_clusters,
+    calculate_hw_iou,
     collect_boxes,
     extract_boxes,
+    build_anchor_table,
     build_anchor_ops,
     build_grid,
     build_offset,
@@ -24,16 +43,28 @@ from .target_utils import (
     build_target,
 )
 
+from .cache_utils import (
+    load_target_cache,
+    build_cache_key,
+    write_target_cache,
+    read_target_cache,
+    build_flip_indices,
+)
+
 from .bbox_utils import (
     calculate_iou,
     bbox_to_delta,
     delta_to_bbox,
+    extract_gt_areas,
 )
 
 from .model_utils import (
     yolo_v3,
     DarkNet53,
     conv_block,
+    remat_block,
+    RecomputeBlock,
+    transfer_weights,
     yolo_head,
     decode_pred,
 )
@@ -46,8 +77,17 @@ from .loss_utils import (
 )
 
 from .opt_utils import (
+    set_precision,
     build_optimizer,
+    compute_gradients,
     forward_backward,
+    build_accumulator,
+    accumulate_gradients,
+    apply_accumulated,
+    build_ema,
+    update_ema,
+    swap_ema,
+    build_train_step,
 )
 
 from .args_utils import (
@@ -60,28 +100,64 @@ from .neptune_utils import (
     record_result,
 )
 
+from .metric_utils import (
+    MetricSink,
+    NeptuneBackend,
+    JsonlBackend,
+    CsvBackend,
+    build_metric_sink,
+    format_latest,
+)
+
+from .profile_utils import (
+    StageProfiler,
+)
+
 from .variable import (
     NEPTUNE_API_KEY,
     NEPTUNE_PROJECT,
 )
 
 from .result_utils import (
-    calculate_pr,
     draw_output,
-    calculate_ap,
-    calculate_ap_const,
-    calculate_ap_per_class,
     calculate_pr,
+    calculate_ap_per_class,
+    calculate_iou_matrix,
+    calculate_area,
+    MeanAveragePrecision,
+    build_eval_pool,
+    MetricConsumer,
+    match_samples,
+    match_best_gt,
+    match_coco_gt,
+    build_ap_metrics,
+    format_aps,
 )
 
 from .gpu_utils import (
     gpu_memory_growth,
 )
 
+from .dist_utils import (
+    build_strategy,
+    is_chief,
+    sync_workers,
+    build_tf_config,
+)
+
+from .ckpt_utils import (
+    AsyncCheckpoint,
+    load_ckpt_step,
+    load_ckpt_weights,
+    clear_eval_markers,
+    load_external_weights,
+)
+
 from .process_utils import (
     initialize_process,
     run_process,
     train,
     validation,
     test,
+    run_evaluator,
 )
@@ -1,43 +1,63 @@
 import os
+import time
+import hashlib
 import numpy as np
 import pandas as pd
 import tensorflow as tf
+import tensorflow_datasets as tfds
 from tqdm import tqdm
-from sklearn.cluster import KMeans
-from tensorflow.keras.layers import Lambda
+from concurrent.futures import ThreadPoolExecutor
 
 
-def load_box_prior(dataset, name, data_dir, img_size, data_num, k_per_grid=3):
-    box_prior_dir = f"{data_dir}/data_chkr/{''.join(char for char in name if char.isalnum())}_box_prior.csv"
+def load_box_prior(
+    name, data_dir, img_size, k_per_grid=3, kmeans_batch_size=0, kmeans_workers=1
+):
+    data_name = "".join(char for char in name if char.isalnum())
+    box_hw_dir = f"{data_dir}/data_chkr/{data_name}_box_hw.npy"
+    if not (os.path.exists(box_hw_dir)):
+        box_hws = collect_boxes(name, data_dir, [1, 1])
+        np.save(box_hw_dir, box_hws)
+    else:
+        box_hws = np.load(box_hw_dir)
+    gt_hws = box_hws * np.asarray(img_size, dtype=np.float32)
+
+    prior_key = build_prior_key(gt_hws, img_size, k_per_grid)
+    box_prior_dir = f"{data_dir}/data_chkr/{data_name}_box_prior_{prior_key}.csv"
     if not (os.path.exists(box_prior_dir)):
-        box_prior = build_box_prior(dataset, img_size, data_num, k_per_grid)
+        box_prior = build_box_prior(
+            gt_hws, k_per_grid, kmeans_batch_size, kmeans_workers
+        )
         box_prior.to_csv(box_prior_dir, index=False, header=False)
+        box_prior = box_prior.to_numpy()
     else:
         box_prior = pd.read_csv(box_prior_dir, header=None).to_numpy()
-        box_prior = tf.cast(box_prior, dtype=tf.float32)
+    box_prior = tf.cast(box_prior, dtype=tf.float32)
 
     return box_prior
 
 
-def build_box_prior(dataset, img_size, data_num, k_per_grid):
-    gt_hws = collect_boxes(dataset, data_num, img_size)
-    hw_area = gt_hws[..., 0] * gt_hws[..., 1]
-    hw1 = gt_hws[hw_area <= np.quantile(hw_area, 0.333333)]
-    hw2 = gt_hws[
-        np.logical_and(
-            hw_area > np.quantile(hw_area, 0.333333),
-            hw_area <= np.quantile(hw_area, 0.666666),
-        )
-    ]
-    hw3 = gt_hws[hw_area > np.quantile(hw_area, 0.666666)]
+def build_prior_key(gt_hws, img_size, k_per_grid):
+    prior_key = hashlib.sha1()
+    prior_key.update(np.ascontiguousarray(gt_hws, dtype=np.float32).tobytes())
+    prior_key.update(np.asarray(img_size, dtype=np.int64).tobytes())
+    prior_key.update(np.int64(k_per_grid).tobytes())
 
-    box_prior = []
-    progress = tqdm(range(3))
-    progress.set_description("Clustering boxes")
-    for i in progress:
-        cluster_sample = (hw1, hw2, hw3)[i]
-        box_prior.append(k_means(cluster_sample, k_per_grid))
-    box_prior = np.concatenate(box_prior)
+    return prior_key.hexdigest()[:16]
+
+
+def build_box_prior(gt_hws, k_per_grid, kmeans_batch_size=0, kmeans_workers=1):
+    start_time = time.time()
+    box_prior = k_means(
+        gt_hws,
+        3 * k_per_grid,
+        batch_size=kmeans_batch_size,
+        workers=kmeans_workers,
+    )
+    cluster_time = time.time() - start_time
+    mean_iou = np.mean(np.max(calculate_hw_iou(gt_hws, box_prior), axis=-1))
+    print(
+        f"\nClustered {len(gt_hws)} boxes into {len(box_prior)} priors in {cluster_time:.2f}s | mean best-anchor IoU {mean_iou:.4f}\n"
+    )
 
     prior_df = pd.DataFrame(box_prior, columns=["height", "width"])
     prior_df.insert(2, "area", box_prior[..., 0] * box_prior[..., 1])
@@ -47,44 +67,135 @@ def build_box_prior(dataset, img_size, data_num, k_per_grid):
     return prior_df
 
 
-def k_means(cluster_sample, k_per_grid):
-    model = KMeans(n_clusters=k_per_grid, random_state=1)
-    model.fit(cluster_sample)
-    box_prior = model.cluster_centers_
+def k_means(cluster_sample, k, batch_size=0, workers=1, max_iter=300, tol=1e-4, seed=1):
+    cluster_sample = np.asarray(cluster_sample, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    centers = init_centers(cluster_sample, k, rng)
+    counts = np.zeros(k)
 
-    return box_prior
+    progress = tqdm(range(max_iter))
+    progress.set_description("Clustering boxes")
+    for _ in progress:
+        if batch_size > 0:
+            batch = cluster_sample[rng.integers(0, len(cluster_sample), batch_size)]
+        else:
+            batch = cluster_sample
+        assignment = assign_clusters(batch, centers, workers)
+
+        batch_counts = np.bincount(assignment, minlength=k)
+        batch_sums = np.stack(
+            [
+                np.bincount(assignment, weights=batch[:, 0], minlength=k),
+                np.bincount(assignment, weights=batch[:, 1], minlength=k),
+            ],
+            axis=-1,
+        )
+        if batch_size > 0:
+            counts += batch_counts
+            learning_rate = np.where(
+                counts > 0, batch_counts / np.maximum(counts, 1), 0
+            )
+        else:
+            learning_rate = (batch_counts > 0).astype(np.float64)
+        batch_means = batch_sums / np.maximum(batch_counts, 1)[:, None]
+        new_centers = centers + learning_rate[:, None] * (batch_means - centers)
+
+        shift = np.max(np.abs(new_centers - centers) / centers)
+        centers = new_centers.astype(np.float32)
+        if shift < tol:
+            break
+
+    return centers
+
+
+def init_centers(cluster_sample, k, rng, sample_size=20000):
+    candidates = cluster_sample[
+        rng.choice(
+            len(cluster_sample), min(sample_size, len(cluster_sample)), replace=False
+        )
+    ]
+    centers = [candidates[rng.integers(len(candidates))]]
+    for _ in range(k - 1):
+        distance = 1.0 - np.max(
+            calculate_hw_iou(candidates, np.stack(centers)), axis=-1
+        )
+        weights = distance**2
+        centers.append(
+            candidates[rng.choice(len(candidates), p=weights / weights.sum())]
+        )
 
+    return np.stack(centers)
 
-def collect_boxes(dataset, data_num, img_size):
+
+def assign_clusters(cluster_sample, centers, workers=1, chunk_size=65536):
+    chunks = [
+        cluster_sample[i : i + chunk_size]
+        for i in range(0, len(cluster_sample), chunk_size)
+    ]
+    assign_fn = lambda chunk: np.argmax(calculate_hw_iou(chunk, centers), axis=-1)
+    if workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            assignment = list(executor.map(assign_fn, chunks))
+    else:
+        assignment = [assign_fn(chunk) for chunk in chunks]
+
+    return np.concatenate(assignment)
+
+
+def calculate_hw_iou(hws, centers):
+    intersection = np.minimum(hws[:, None, 0], centers[None, :, 0]) * np.minimum(
+        hws[:, None, 1], centers[None, :, 1]
+    )
+    union = (
+        (hws[:, 0] * hws[:, 1])[:, None]
+        + (centers[:, 0] * centers[:, 1])[None, :]
+        - intersection
+    )
+
+    return intersection / union
+
+
+def collect_boxes(name, data_dir, img_size, batch_size=256):
     prior_samples = []
-    progress = tqdm(range(data_num))
-    progress.set_description("Collecting boxes extraced from gt_boxes")
-    for _ in progress:
-        image, gt_boxes, gt_labels = next(dataset)
-        prior_sample = extract_boxes(gt_boxes, img_size)
-        prior_samples.append(prior_sample)
-    gt_hws = tf.concat(prior_samples, axis=0)
+    for split in ("train", "validation[100:]"):
+        box_set = tfds.load(
+            name=name,
+            split=split,
+            data_dir=f"{data_dir}/tfds",
+            decoders={"image": tfds.decode.SkipDecoding()},
+        )
+        box_set = box_set.map(
+            lambda x: x["objects"]["bbox"],
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        ).padded_batch(batch_size, padded_shapes=[None, 4])
+        progress = tqdm(tfds.as_numpy(box_set))
+        progress.set_description(f"Collecting boxes extraced from {split} gt_boxes")
+        for gt_boxes in progress:
+            prior_samples.append(extract_boxes(gt_boxes, img_size))
+    gt_hws = np.concatenate(prior_samples, axis=0)
 
     return gt_hws
 
 
 def extract_boxes(gt_boxes, img_size):
-    y1, x1, y2, x2 = tf.split(gt_boxes, 4, axis=-1)
-    gt_heights = (y2 - y1) * tf.constant(img_size[0], dtype=tf.float32)
-    gt_widths = (x2 - x1) * tf.constant(img_size[1], dtype=tf.float32)
-    prior_sample = tf.concat([gt_heights, gt_widths], axis=-1)
-    prior_sample = tf.reshape(
-        prior_sample, (tf.shape(prior_sample)[0] * tf.shape(prior_sample)[1], 2)
-    )
-    not_zero = tf.not_equal(prior_sample, 0)
-    not_zero = tf.logical_and(
-        Lambda(lambda x: x[..., 0])(not_zero), Lambda(lambda x: x[..., 1])(not_zero)
-    )
-    prior_sample = Lambda(lambda x: x[not_zero])(prior_sample)
+    gt_heights = (gt_boxes[..., 2] - gt_boxes[..., 0]) * img_size[0]
+    gt_widths = (gt_boxes[..., 3] - gt_boxes[..., 1]) * img_size[1]
+    prior_sample = np.stack([gt_heights, gt_widths], axis=-1).reshape(-1, 2)
+    not_zero = np.all(prior_sample != 0, axis=-1)
+    prior_sample = prior_sample[not_zero]
 
     return prior_sample
 
 
+def build_anchor_table(img_sizes, box_priors, prior_img_size):
+    anchor_table = {}
+    for img_size in img_sizes:
+        scaled_priors = box_priors * (img_size[0] / prior_img_size[0])
+        anchor_table[tuple(img_size)] = build_anchor_ops(img_size, scaled_priors)
+
+    return anchor_table
+
+
 def build_anchor_ops(img_size, box_priors):
     anchors_lst = []
     prior_grids_lst = []
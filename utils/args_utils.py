@@ -1,3 +1,4 @@
+import os
 import argparse
 
 
@@ -6,13 +7,68 @@ def build_args():
     parser.add_argument("--epochs", type=int, default=160)
     parser.add_argument("--data-dir", type=str, default="D:/won/data")
     parser.add_argument("--img-size", nargs="+", type=int, default=[416, 416])
+    parser.add_argument("--multi-scale", nargs="*", type=int, default=[])
+    parser.add_argument("--mosaic-prob", type=float, default=0.0)
+    parser.add_argument("--mixup-prob", type=float, default=0.0)
     parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--eval-batch-size", type=int, default=8)
     parser.add_argument("--name", type=str, default="voc/2007")
     parser.add_argument("--lambda-yx", type=float, default=1e-1)
     parser.add_argument("--lambda-hw", type=float, default=1e-5)
     parser.add_argument("--lambda-obj", type=float, default=1e-1)
     parser.add_argument("--lambda-nobj", type=float, default=1e-4)
     parser.add_argument("--lambda-cls", type=float, default=1e-3)
+    parser.add_argument("--ignore-threshold", type=float, default=0.5)
+    parser.add_argument("--kmeans-batch-size", type=int, default=0)
+    parser.add_argument("--kmeans-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--target-in-pipeline", action="store_true")
+    parser.add_argument("--target-cache", action="store_true")
+    parser.add_argument("--image-store", action="store_true")
+    parser.add_argument("--multi-worker", action="store_true")
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="seeds the input order, augmentation and multi-scale choice",
+    )
+    parser.add_argument("--steps-per-execution", type=int, default=1)
+    parser.add_argument("--accum-steps", type=int, default=1)
+    parser.add_argument("--log-every", type=int, default=50)
+    parser.add_argument(
+        "--log-backends",
+        nargs="+",
+        type=str,
+        default=["neptune"],
+        choices=["neptune", "jsonl", "csv"],
+    )
+    parser.add_argument("--profile-stages", action="store_true")
+    parser.add_argument("--profile-steps", nargs=2, type=int, default=None)
+    parser.add_argument("--ema-decay", type=float, default=0.0)
+    parser.add_argument(
+        "--map-method", type=str, default="voc07", choices=["voc07", "voc12", "coco"]
+    )
+    parser.add_argument("--eval-workers", type=int, default=1)
+    parser.add_argument(
+        "--eval-mode", type=str, default="inline", choices=["inline", "external"]
+    )
+    parser.add_argument("--eval-timeout", type=int, default=3600)
+    parser.add_argument("--evaluator", action="store_true")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue from the last checkpoint in --ckpt-dir, replaying the input "
+        "order, augmentation and multi-scale choice of the interrupted run; "
+        "nondeterministic GPU kernels are not pinned, so losses can still drift",
+    )
+    parser.add_argument("--ckpt-dir", type=str, default=None)
+    parser.add_argument("--ckpt-every", type=int, default=1000)
+    parser.add_argument("--remat", type=str, default=None, choices=["block", "stage"])
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="float32",
+        choices=["float32", "mixed_float16", "mixed_bfloat16"],
+    )
 
     try:
         args = parser.parse_args()
@@ -34,11 +34,13 @@ def calculate_iou(anchors: tf.Tensor, gt_boxes: tf.Tensor) -> tf.Tensor:
     return intersection_area / union_area
 
 
-def delta_to_bbox(delta_yx, delta_hw, stride_grids):
+def delta_to_bbox(delta_yx, delta_hw, stride_grids, img_size):
     delta_yx = delta_yx * tf.broadcast_to(stride_grids, tf.shape(delta_yx))
     bbox_y1x1 = delta_yx - (0.5 * delta_hw)
     bbox_y2x2 = delta_yx + (0.5 * delta_hw)
-    bbox = tf.concat([bbox_y1x1, bbox_y2x2], axis=-1) / 416
+    bbox = tf.concat([bbox_y1x1, bbox_y2x2], axis=-1) / tf.constant(
+        list(img_size) * 2, dtype=tf.float32
+    )
     bbox = tf.clip_by_value(bbox, 0.0, 1.0)
 
     return bbox
@@ -57,3 +59,14 @@ def bbox_to_delta(bbox, img_size, stride_grids):
     delta_hw = tf.concat([delta_h, delta_w], axis=-1)
 
     return delta_yx, delta_hw
+
+
+def extract_gt_areas(objects, gt_boxes, image_shape):
+    if "area" in objects:
+        return tf.cast(objects["area"], dtype=tf.float32)
+    image_shape = tf.cast(image_shape, dtype=tf.float32)
+    gt_areas = (gt_boxes[..., 2] - gt_boxes[..., 0]) * (
+        gt_boxes[..., 3] - gt_boxes[..., 1]
+    )
+
+    return gt_areas * image_shape[0] * image_shape[1]
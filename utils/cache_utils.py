@@ -0,0 +1,247 @@
+import os
+import hashlib
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+from .data_utils import export_data, build_sample_seed, draw_uniform
+from .target_utils import build_target
+
+
+def load_target_cache(
+    dataset,
+    name,
+    data_dir,
+    batch_size,
+    img_size,
+    box_priors,
+    anchors,
+    stride_grids,
+    labels,
+    ignore_threshold=0.5,
+    num_shards=16,
+    input_context=None,
+    skip_samples=0,
+    deterministic=False,
+    seed=0,
+):
+    cache_key = build_cache_key(name, img_size, box_priors, ignore_threshold)
+    cache_dir = f"{data_dir}/data_chkr/{''.join(char for char in name if char.isalnum())}_target_cache_{cache_key}"
+    if not (os.path.exists(f"{cache_dir}/done.txt")):
+        write_target_cache(
+            dataset,
+            cache_dir,
+            img_size,
+            anchors,
+            stride_grids,
+            labels,
+            ignore_threshold,
+            num_shards,
+        )
+    with open(f"{cache_dir}/done.txt", "r") as f:
+        data_num = int(f.readline())
+    shards = range(num_shards)
+    if input_context is not None:
+        shards = shards[
+            input_context.input_pipeline_id :: input_context.num_input_pipelines
+        ]
+    shard_num = sum(len(range(shard, data_num, num_shards)) for shard in shards)
+    cache_set = read_target_cache(
+        cache_dir,
+        img_size,
+        stride_grids,
+        labels,
+        input_context,
+        skip_samples % max(shard_num, 1),
+        deterministic,
+        seed,
+        skip_samples,
+    )
+    cache_set = cache_set.batch(batch_size, drop_remainder=True)
+
+    return cache_set
+
+
+def build_cache_key(name, img_size, box_priors, ignore_threshold):
+    cache_key = hashlib.sha1()
+    cache_key.update(name.encode())
+    cache_key.update(np.asarray(img_size, dtype=np.int64).tobytes())
+    cache_key.update(np.asarray(box_priors, dtype=np.float32).tobytes())
+    cache_key.update(np.float32(ignore_threshold).tobytes())
+
+    return cache_key.hexdigest()[:16]
+
+
+def write_target_cache(
+    dataset,
+    cache_dir,
+    img_size,
+    anchors,
+    stride_grids,
+    labels,
+    ignore_threshold,
+    num_shards,
+):
+    os.makedirs(cache_dir, exist_ok=True)
+    record_set = dataset.map(
+        lambda x: serialize_sample(
+            x, img_size, anchors, stride_grids, labels, ignore_threshold
+        ),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+    ).prefetch(tf.data.experimental.AUTOTUNE)
+
+    writers = [
+        tf.io.TFRecordWriter(
+            f"{cache_dir}/shard-{shard:05d}-of-{num_shards:05d}.tfrecord"
+        )
+        for shard in range(num_shards)
+    ]
+    data_num = 0
+    progress = tqdm(record_set)
+    progress.set_description("Caching encoded targets")
+    for record in progress:
+        writers[data_num % num_shards].write(record.numpy())
+        data_num += 1
+    for writer in writers:
+        writer.close()
+
+    with open(f"{cache_dir}/done.txt", "w") as f:
+        f.write(str(data_num))
+
+
+def serialize_sample(sample, img_size, anchors, stride_grids, labels, ignore_threshold):
+    image, gt_boxes, gt_labels, _ = export_data(sample)
+    image = tf.cast(
+        tf.round(tf.clip_by_value(tf.image.resize(image, img_size), 0.0, 255.0)),
+        dtype=tf.uint8,
+    )
+    true_yx, true_hw, true_obj, true_nobj, true_cls = build_target(
+        anchors,
+        tf.expand_dims(gt_boxes, axis=0),
+        tf.expand_dims(tf.cast(gt_labels, dtype=tf.int32), axis=0),
+        labels,
+        img_size,
+        stride_grids,
+        ignore_threshold,
+    )
+    pos_indices = tf.cast(tf.where(true_obj[0, :, 0] > 0)[:, 0], dtype=tf.int32)
+    pos_cls = tf.where(
+        tf.reduce_max(true_cls[0], axis=-1) > 0,
+        tf.argmax(true_cls[0], axis=-1, output_type=tf.int32),
+        -1,
+    )
+
+    components = [
+        tf.io.serialize_tensor(image),
+        tf.io.serialize_tensor(pos_indices),
+        tf.io.serialize_tensor(tf.gather(true_yx[0], pos_indices)),
+        tf.io.serialize_tensor(tf.gather(true_hw[0], pos_indices)),
+        tf.io.serialize_tensor(tf.gather(pos_cls, pos_indices)),
+        tf.io.serialize_tensor(tf.cast(true_nobj[0, :, 0], dtype=tf.uint8)),
+    ]
+
+    return tf.io.serialize_tensor(tf.stack(components))
+
+
+def read_target_cache(
+    cache_dir,
+    img_size,
+    stride_grids,
+    labels,
+    input_context=None,
+    skip_samples=0,
+    deterministic=False,
+    seed=0,
+    start_index=0,
+):
+    flip_indices = build_flip_indices(img_size)
+    grid_widths = img_size[1] / stride_grids[:, 1]
+
+    record_files = tf.data.Dataset.list_files(
+        f"{cache_dir}/shard-*.tfrecord", shuffle=False
+    )
+    if input_context is not None:
+        record_files = record_files.shard(
+            input_context.num_input_pipelines, input_context.input_pipeline_id
+        )
+    cache_set = record_files.interleave(
+        tf.data.TFRecordDataset,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=deterministic,
+    )
+    cache_set = (
+        cache_set.repeat()
+        .skip(skip_samples)
+        .enumerate(start_index)
+        .map(
+            lambda index, x: decode_sample(
+                x,
+                img_size,
+                flip_indices,
+                grid_widths,
+                len(labels),
+                build_sample_seed(seed, index, input_context),
+            ),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        )
+    )
+
+    return cache_set
+
+
+def build_flip_indices(img_size):
+    # anchors are laid out as (x, y, prior) per stride, see build_grid
+    flip_indices = []
+    offset = 0
+    for stride in (32, 16, 8):
+        feature_map_shape = img_size[0] // stride
+        grid_indices = tf.reshape(
+            tf.range(feature_map_shape * feature_map_shape * 3),
+            (feature_map_shape, feature_map_shape, 3),
+        )
+        flip_indices.append(tf.reshape(tf.reverse(grid_indices, [0]), (-1,)) + offset)
+        offset += feature_map_shape * feature_map_shape * 3
+
+    return tf.concat(flip_indices, axis=0)
+
+
+def decode_sample(record, img_size, flip_indices, grid_widths, label_num, seed=None):
+    components = tf.io.parse_tensor(record, tf.string)
+    image = tf.io.parse_tensor(components[0], tf.uint8)
+    pos_indices = tf.io.parse_tensor(components[1], tf.int32)
+    pos_yx = tf.io.parse_tensor(components[2], tf.float32)
+    pos_hw = tf.io.parse_tensor(components[3], tf.float32)
+    pos_cls = tf.io.parse_tensor(components[4], tf.int32)
+    nobj = tf.io.parse_tensor(components[5], tf.uint8)
+
+    image = tf.ensure_shape(image, img_size + [3])
+    anchor_num = tf.shape(flip_indices)[0]
+    if draw_uniform([], seed) > 0.5:
+        image = tf.image.flip_left_right(image)
+        pos_indices = tf.gather(flip_indices, pos_indices)
+        pos_yx = tf.stack(
+            [pos_yx[:, 0], tf.gather(grid_widths, pos_indices) - pos_yx[:, 1]],
+            axis=-1,
+        )
+        nobj = tf.gather(nobj, flip_indices)
+
+    scatter_indices = tf.expand_dims(pos_indices, axis=-1)
+    true_yx = tf.scatter_nd(scatter_indices, pos_yx, tf.stack([anchor_num, 2]))
+    true_hw = tf.scatter_nd(scatter_indices, pos_hw, tf.stack([anchor_num, 2]))
+    true_obj = tf.scatter_nd(
+        scatter_indices, tf.ones_like(pos_indices, dtype=tf.float32), [anchor_num]
+    )
+    true_nobj = tf.cast(nobj, dtype=tf.float32)
+    true_cls = tf.one_hot(
+        tf.scatter_nd(scatter_indices, pos_cls + 1, [anchor_num]) - 1,
+        label_num,
+        dtype=tf.float32,
+    )
+    true = (
+        true_yx,
+        true_hw,
+        tf.expand_dims(true_obj, axis=-1),
+        tf.expand_dims(true_nobj, axis=-1),
+        true_cls,
+    )
+
+    return image, true
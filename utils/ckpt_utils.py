@@ -0,0 +1,113 @@
+import os
+import re
+import time
+import threading
+import tensorflow as tf
+
+
+class AsyncCheckpoint:
+    def __init__(
+        self,
+        model,
+        optimizer,
+        ckpt_dir,
+        writer=True,
+        max_to_keep=3,
+        ema_weights=None,
+    ):
+        self.variables = model.weights + optimizer.weights + (ema_weights or [])
+        self.writer = writer
+        with tf.device("/cpu:0"):
+            self.shadows = [
+                tf.Variable(tf.zeros(var.shape, var.dtype), trainable=False)
+                for var in self.variables
+            ]
+            self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+            self.best_mean_ap = tf.Variable(0.0, trainable=False)
+        self.checkpoint = tf.train.Checkpoint(
+            variables=self.shadows, step=self.step, best_mean_ap=self.best_mean_ap
+        )
+        self.manager = tf.train.CheckpointManager(
+            self.checkpoint, ckpt_dir, max_to_keep=max_to_keep
+        )
+        self.thread = None
+
+    def save(self, step, best_mean_ap):
+        if not self.writer:
+            return
+        self.wait()
+        for shadow, var in zip(self.shadows, self.variables):
+            shadow.assign(var)
+        self.step.assign(step)
+        self.best_mean_ap.assign(best_mean_ap)
+        self.thread = threading.Thread(
+            target=self.manager.save, kwargs={"checkpoint_number": step}
+        )
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def restore(self):
+        if self.manager.latest_checkpoint is None:
+            return 0, 0.0
+        self.checkpoint.restore(self.manager.latest_checkpoint).assert_consumed()
+        for shadow, var in zip(self.shadows, self.variables):
+            var.assign(shadow)
+
+        return int(self.step.numpy()), float(self.best_mean_ap.numpy())
+
+
+def load_ckpt_step(ckpt_dir):
+    latest_checkpoint = tf.train.latest_checkpoint(ckpt_dir)
+    if latest_checkpoint is None:
+        return 0
+
+    return int(
+        tf.train.load_variable(latest_checkpoint, "step/.ATTRIBUTES/VARIABLE_VALUE")
+    )
+
+
+def load_ckpt_weights(model, ckpt_path, use_ema=False):
+    reader = tf.train.load_checkpoint(ckpt_path)
+    variable_num = len(
+        [
+            key
+            for key in reader.get_variable_to_shape_map()
+            if re.fullmatch(r"variables/\d+/\.ATTRIBUTES/VARIABLE_VALUE", key)
+        ]
+    )
+    offset = variable_num - len(model.weights) if use_ema else 0
+    for index, weight in enumerate(model.weights):
+        weight.assign(
+            reader.get_tensor(f"variables/{offset + index}/.ATTRIBUTES/VARIABLE_VALUE")
+        )
+
+    return int(reader.get_tensor("step/.ATTRIBUTES/VARIABLE_VALUE"))
+
+
+def clear_eval_markers(ckpt_dir, resume=False):
+    markers = ["train_done.txt", "eval_done.txt"]
+    if not resume:
+        markers.append("best_weights.h5")
+    for marker in markers:
+        if os.path.exists(f"{ckpt_dir}/{marker}"):
+            os.remove(f"{ckpt_dir}/{marker}")
+
+
+def load_external_weights(model, ckpt_dir, eval_timeout, use_ema=False):
+    start_time = time.time()
+    while not os.path.exists(f"{ckpt_dir}/eval_done.txt"):
+        if time.time() - start_time > eval_timeout:
+            print(f"Evaluator did not finish within {eval_timeout}s")
+            break
+        time.sleep(30)
+    if os.path.exists(f"{ckpt_dir}/best_weights.h5"):
+        return f"{ckpt_dir}/best_weights.h5"
+
+    load_ckpt_weights(model, tf.train.latest_checkpoint(ckpt_dir), use_ema)
+    model.save_weights(f"{ckpt_dir}/latest_weights.h5")
+
+    return f"{ckpt_dir}/latest_weights.h5"
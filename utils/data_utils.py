@@ -2,52 +2,66 @@ import os
 import tensorflow as tf
 import tensorflow_datasets as tfds
 from typing import Tuple
-from tensorflow.keras.layers import Lambda
+from .store_utils import load_image_store
+from .bbox_utils import extract_gt_areas
 
 
-def load_dataset(name, data_dir):
+def load_dataset(name, data_dir, img_size=None, image_store=False):
+    decoders = {"image": tfds.decode.SkipDecoding()}
     train1, dataset_info = tfds.load(
-        name=name, split="train", data_dir=f"{data_dir}/tfds", with_info=True
+        name=name,
+        split="train",
+        data_dir=f"{data_dir}/tfds",
+        with_info=True,
+        decoders=decoders,
     )
     train2 = tfds.load(
         name=name,
         split="validation[100:]",
         data_dir=f"{data_dir}/tfds",
+        decoders=decoders,
     )
     valid_set = tfds.load(
         name=name,
         split="validation[:100]",
         data_dir=f"{data_dir}/tfds",
+        decoders=decoders,
     )
     test_set = tfds.load(
         name=name,
         split="train[:10%]",
         data_dir=f"{data_dir}/tfds",
+        decoders=decoders,
     )
     train_set = train1.concatenate(train2)
 
-    train_num, valid_num, test_num = load_data_num(
-        name, data_dir, train_set, valid_set, test_set
-    )
+    train_num, valid_num, test_num = load_data_num(name, data_dir, dataset_info)
 
     try:
         labels = dataset_info.features["labels"].names
     except:
         labels = dataset_info.features["objects"]["label"].names
 
-    return (train_set, valid_set, test_set), labels, train_num, valid_num, test_num
+    datasets = (train_set, valid_set, test_set)
+    if image_store:
+        datasets = load_image_store(
+            datasets, name, data_dir, img_size, (train_num, valid_num, test_num)
+        )
+
+    return datasets, labels, train_num, valid_num, test_num
 
 
-def load_data_num(name, data_dir, train_set, valid_set, test_set):
+def load_data_num(name, data_dir, dataset_info):
     data_nums = []
-    for dataset, dataset_name in (
-        (train_set, "train"),
-        (valid_set, "validation")(test_set, "test"),
+    for dataset_name, splits in (
+        ("train", ("train", "validation[100:]")),
+        ("validation", ("validation[:100]",)),
+        ("test", ("train[:10%]",)),
     ):
         data_num_dir = f"{data_dir}/data_chkr/{''.join(char for char in name if char.isalnum())}_{dataset_name}_num.txt"
 
         if not (os.path.exists(data_num_dir)):
-            data_num = build_data_num(dataset, dataset_name)
+            data_num = build_data_num(name, data_dir, dataset_info, splits)
             with open(data_num_dir, "w") as f:
                 f.write(str(data_num))
                 f.close()
@@ -59,110 +73,218 @@ def load_data_num(name, data_dir, train_set, valid_set, test_set):
     return data_nums
 
 
-def build_data_num(dataset, dataset_name):
-    num_chkr = iter(dataset)
+def build_data_num(name, data_dir, dataset_info, splits):
     data_num = 0
-    print(f"\nCounting number of {dataset_name} data\n")
-    while True:
+    for split in splits:
         try:
-            next(num_chkr)
-        except:
-            break
-        data_num += 1
+            split_num = dataset_info.splits[split].num_examples
+        except (KeyError, ValueError):
+            split_num = 0
+        if split_num == 0:
+            split_num = count_records(name, data_dir, split)
+        data_num += split_num
 
     return data_num
 
 
-def build_dataset(datasets, batch_size, img_size, strategy):
+def count_records(name, data_dir, split):
+    print(f"\nCounting number of {split} data\n")
+    dataset = tfds.load(
+        name=name,
+        split=split,
+        data_dir=f"{data_dir}/tfds",
+        decoders={"image": tfds.decode.SkipDecoding()},
+    )
+    data_num = dataset.reduce(0, lambda count, _: count + 1)
+
+    return int(data_num)
+
+
+def build_dataset(
+    datasets,
+    batch_size,
+    img_size,
+    mosaic_prob=0.0,
+    mixup_prob=0.0,
+    rescale=True,
+    input_context=None,
+    eval_batch_size=1,
+    skip_samples=0,
+    deterministic=False,
+    seed=0,
+    start_index=0,
+):
     train_set, valid_set, test_set = datasets
+    if input_context is not None:
+        train_set = train_set.shard(
+            input_context.num_input_pipelines, input_context.input_pipeline_id
+        )
     data_shapes = ([None, None, None], [None, None], [None])
     padding_values = (
-        tf.constant(0, tf.float32),
+        tf.constant(0, tf.float32 if rescale else tf.uint8),
         tf.constant(0, tf.float32),
         tf.constant(-1, tf.int32),
     )
+    eval_shapes = data_shapes + ([2], [None])
+    eval_padding_values = padding_values + (
+        tf.constant(0, tf.int32),
+        tf.constant(0, tf.float32),
+    )
+    autotune = tf.data.experimental.AUTOTUNE
 
-    train_set = train_set.map(lambda x: preprocess(x, split="train", img_size=img_size))
-    test_set = test_set.map(lambda x: preprocess(x, split="test", img_size=img_size))
+    train_options = tf.data.Options()
+    train_options.experimental_deterministic = deterministic
+    train_set = train_set.with_options(train_options)
+
+    def preprocess_train(index, sample):
+        sample_seed = build_sample_seed(seed, index, input_context)
+        return (sample_seed,) + preprocess(
+            sample, split="train", img_size=img_size, rescale=rescale, seed=sample_seed
+        )
+
+    train_set = (
+        train_set.repeat()
+        .skip(skip_samples)
+        .enumerate(start_index)
+        .map(preprocess_train, num_parallel_calls=autotune)
+    )
+    test_set = test_set.map(
+        lambda x: preprocess(x, split="test", img_size=img_size, rescale=rescale),
+        num_parallel_calls=autotune,
+    )
     valid_set = valid_set.map(
-        lambda x: preprocess(x, split="validation", img_size=img_size)
+        lambda x: preprocess(x, split="validation", img_size=img_size, rescale=rescale),
+        num_parallel_calls=autotune,
     )
 
-    train_set = train_set.repeat().padded_batch(
+    train_set = train_set.padded_batch(
         batch_size,
-        padded_shapes=data_shapes,
-        padding_values=padding_values,
+        padded_shapes=([2],) + data_shapes,
+        padding_values=(tf.constant(0, tf.int64),) + padding_values,
         drop_remainder=True,
+    ).map(
+        lambda sample_seeds, image, gt_boxes, gt_labels: augment_batch(
+            image,
+            gt_boxes,
+            gt_labels,
+            img_size,
+            mosaic_prob,
+            mixup_prob,
+            sample_seeds[0],
+        ),
+        num_parallel_calls=autotune,
     )
-    valid_set = valid_set.repeat().padded_batch(
-        batch_size=1,
-        padded_shapes=data_shapes,
-        padding_values=padding_values,
-        drop_remainder=True,
+    valid_set = valid_set.padded_batch(
+        batch_size=eval_batch_size,
+        padded_shapes=eval_shapes,
+        padding_values=eval_padding_values,
     )
-    test_set = test_set.repeat().padded_batch(
-        batch_size=1,
-        padded_shapes=data_shapes,
-        padding_values=padding_values,
-        drop_remainder=True,
+    test_set = test_set.padded_batch(
+        batch_size=eval_batch_size,
+        padded_shapes=eval_shapes,
+        padding_values=eval_padding_values,
     )
 
-    train_set = train_set.prefetch(tf.data.experimental.AUTOTUNE)
-    valid_set = valid_set.prefetch(tf.data.experimental.AUTOTUNE)
-    test_set = test_set.prefetch(tf.data.experimental.AUTOTUNE)
+    return train_set, valid_set, test_set
+
+
+def build_iterator(datasets, strategy, target_fn=None):
+    dataset_fn, valid_set, test_set = datasets
+    autotune = tf.data.experimental.AUTOTUNE
+
+    def train_fn(input_context):
+        train_set = dataset_fn(input_context)
+        if target_fn is not None:
+            train_set = train_set.map(
+                lambda image, gt_boxes, gt_labels: (
+                    image,
+                    target_fn(gt_boxes, gt_labels),
+                ),
+                num_parallel_calls=autotune,
+            )
+        return train_set.prefetch(autotune)
 
-    train_set = strategy.experimental_distribute_dataset(train_set)
+    valid_set = valid_set.prefetch(autotune)
+    test_set = test_set.prefetch(autotune)
+
+    train_set = strategy.distribute_datasets_from_function(train_fn)
 
     train_set = iter(train_set)
-    valid_set = iter(valid_set)
-    test_set = iter(test_set)
 
     return train_set, valid_set, test_set
 
 
 def export_data(sample):
-    image = Lambda(lambda x: x["image"])(sample)
-    gt_boxes = Lambda(lambda x: x["objects"]["bbox"])(sample)
-    gt_labels = Lambda(lambda x: x["objects"]["label"])(sample)
-    try:
-        is_diff = Lambda(lambda x: x["objects"]["is_crowd"])(sample)
-    except:
-        is_diff = Lambda(lambda x: x["objects"]["is_difficult"])(sample)
+    image = sample["image"]
+    if image.dtype == tf.string:
+        image = tf.io.decode_image(image, channels=3, expand_animations=False)
+    gt_boxes = sample["objects"]["bbox"]
+    gt_labels = sample["objects"]["label"]
+    if "is_crowd" in sample["objects"]:
+        is_diff = sample["objects"]["is_crowd"]
+    else:
+        is_diff = sample["objects"]["is_difficult"]
 
     return image, gt_boxes, gt_labels, is_diff
 
 
+def export_eval_info(sample, image, gt_boxes):
+    if "image_shape" in sample:
+        image_shape = tf.cast(sample["image_shape"], dtype=tf.int32)
+    else:
+        image_shape = tf.shape(image)[:2]
+    gt_areas = extract_gt_areas(sample["objects"], gt_boxes, image_shape)
+
+    return image_shape, gt_areas
+
+
+def build_sample_seed(seed, index, input_context=None):
+    if input_context is not None:
+        index = (
+            index * input_context.num_input_pipelines + input_context.input_pipeline_id
+        )
+
+    return tf.stack([tf.cast(seed, tf.int64), index])
+
+
+def draw_uniform(shape, seed=None, minval=0.0, maxval=1.0):
+    if seed is None:
+        return tf.random.uniform(shape, minval, maxval)
+
+    return tf.random.stateless_uniform(shape, seed, minval, maxval)
+
+
 def resize_and_rescale(image, img_size):
-    transform = tf.keras.Sequential(
-        [
-            tf.keras.layers.experimental.preprocessing.Resizing(
-                img_size[0], img_size[1]
-            ),
-            tf.keras.layers.experimental.preprocessing.Rescaling(1.0 / 255.0),
-        ]
-    )
-    image = transform(image)
+    image = tf.image.resize(image, img_size) * (1.0 / 255.0)
 
     return image
 
 
-def evaluate(gt_boxes, gt_labels, is_diff):
+def rescale_image(image):
+    if image.dtype == tf.uint8:
+        image = tf.cast(image, dtype=tf.float32) * (1.0 / 255.0)
+
+    return image
+
+
+def evaluate(gt_boxes, gt_labels, gt_areas, is_diff):
     not_diff = tf.logical_not(is_diff)
-    gt_boxes = Lambda(lambda x: x[not_diff])(gt_boxes)
-    gt_labels = Lambda(lambda x: x[not_diff])(gt_labels)
+    gt_boxes = tf.boolean_mask(gt_boxes, not_diff)
+    gt_labels = tf.boolean_mask(gt_labels, not_diff)
+    gt_areas = tf.boolean_mask(gt_areas, not_diff)
 
-    return gt_boxes, gt_labels
+    return gt_boxes, gt_labels, gt_areas
 
 
-def rand_flip_horiz(image: tf.Tensor, gt_boxes: tf.Tensor) -> Tuple:
-    if tf.random.uniform([1]) > tf.constant([0.5]):
+def rand_flip_horiz(image: tf.Tensor, gt_boxes: tf.Tensor, seed=None) -> Tuple:
+    if draw_uniform([], seed) > 0.5:
         image = tf.image.flip_left_right(image)
         gt_boxes = tf.stack(
             [
-                Lambda(lambda x: x[..., 0])(gt_boxes),
-                Lambda(lambda x: 1.0 - x[..., 3])(gt_boxes),
-                Lambda(lambda x: x[..., 2])(gt_boxes),
-                Lambda(lambda x: 1.0 - x[..., 1])(gt_boxes),
+                gt_boxes[..., 0],
+                1.0 - gt_boxes[..., 3],
+                gt_boxes[..., 2],
+                1.0 - gt_boxes[..., 1],
             ],
             -1,
         )
@@ -170,13 +292,123 @@ def rand_flip_horiz(image: tf.Tensor, gt_boxes: tf.Tensor) -> Tuple:
     return image, gt_boxes
 
 
-def preprocess(dataset, split, img_size):
+def preprocess(dataset, split, img_size, rescale=True, seed=None):
     image, gt_boxes, gt_labels, is_diff = export_data(dataset)
-    image = resize_and_rescale(image, img_size)
+    image_shape, gt_areas = export_eval_info(dataset, image, gt_boxes)
+    if rescale:
+        image = resize_and_rescale(image, img_size)
     if split == "train":
-        image, gt_boxes = rand_flip_horiz(image, gt_boxes)
-    else:
-        gt_boxes, gt_labels = evaluate(gt_boxes, gt_labels, is_diff)
+        image, gt_boxes = rand_flip_horiz(image, gt_boxes, seed)
+        return image, gt_boxes, tf.cast(gt_labels, dtype=tf.int32)
+    gt_boxes, gt_labels, gt_areas = evaluate(gt_boxes, gt_labels, gt_areas, is_diff)
     gt_labels = tf.cast(gt_labels, dtype=tf.int32)
 
+    return image, gt_boxes, gt_labels, image_shape, gt_areas
+
+
+def augment_batch(
+    image, gt_boxes, gt_labels, img_size, mosaic_prob, mixup_prob, seed=None
+):
+    if seed is None:
+        seeds = [None] * 4
+    else:
+        seeds = tf.unstack(tf.random.experimental.stateless_split(seed, 4))
+    if mosaic_prob > 0:
+        if draw_uniform([], seeds[0]) < mosaic_prob:
+            image, gt_boxes, gt_labels = mosaic_batch(
+                image, gt_boxes, gt_labels, img_size, seed=seeds[1]
+            )
+    if mixup_prob > 0:
+        if draw_uniform([], seeds[2]) < mixup_prob:
+            image, gt_boxes, gt_labels = mixup_batch(
+                image, gt_boxes, gt_labels, seed=seeds[3]
+            )
+
+    return image, gt_boxes, gt_labels
+
+
+def mosaic_batch(image, gt_boxes, gt_labels, img_size, min_box_size=2.0, seed=None):
+    img_h, img_w = img_size
+    center = draw_uniform([2], seed, 0.25, 0.75)
+    ctr_y = tf.cast(center[0] * img_h, tf.int32)
+    ctr_x = tf.cast(center[1] * img_w, tf.int32)
+    quadrants = (
+        (0, 0, ctr_y, ctr_x),
+        (0, ctr_x, ctr_y, img_w - ctr_x),
+        (ctr_y, 0, img_h - ctr_y, ctr_x),
+        (ctr_y, ctr_x, img_h - ctr_y, img_w - ctr_x),
+    )
+
+    image_size = tf.constant([img_h, img_w], dtype=tf.float32)
+
+    tiles, mosaic_boxes, mosaic_labels = [], [], []
+    for shift, (y0, x0, tile_h, tile_w) in enumerate(quadrants):
+        # keep the aspect ratio, cover the quadrant and crop towards the center
+        tile_size = tf.cast(tf.stack([tile_h, tile_w]), tf.float32)
+        resized_size = tf.cast(
+            tf.math.ceil(tf.reduce_max(tile_size / image_size) * image_size),
+            tf.int32,
+        )
+        crop_y = resized_size[0] - tile_h if shift < 2 else 0
+        crop_x = resized_size[1] - tile_w if shift % 2 == 0 else 0
+        tile = tf.image.resize(tf.roll(image, -shift, axis=0), resized_size)
+        tile = tile[:, crop_y : crop_y + tile_h, crop_x : crop_x + tile_w]
+        if image.dtype == tf.uint8:
+            tile = tf.cast(tf.round(tile), dtype=tf.uint8)
+        tiles.append(tile)
+        scale = tf.cast(tf.tile(resized_size, [2]), tf.float32)
+        crop = tf.cast(tf.stack([crop_y, crop_x, crop_y, crop_x]), tf.float32)
+        bound = tf.cast(tf.stack([tile_h, tile_w, tile_h, tile_w]), tf.float32)
+        offset = tf.cast(tf.stack([y0, x0, y0, x0]), tf.float32)
+        tile_boxes = tf.roll(gt_boxes, -shift, axis=0) * scale - crop
+        mosaic_boxes.append(tf.clip_by_value(tile_boxes, 0.0, bound) + offset)
+        mosaic_labels.append(tf.roll(gt_labels, -shift, axis=0))
+
+    image = tf.concat(
+        [
+            tf.concat([tiles[0], tiles[1]], axis=2),
+            tf.concat([tiles[2], tiles[3]], axis=2),
+        ],
+        axis=1,
+    )
+    image = tf.ensure_shape(image, [None, img_h, img_w, 3])
+    gt_boxes = tf.concat(mosaic_boxes, axis=1)
+    gt_labels = tf.concat(mosaic_labels, axis=1)
+    gt_boxes, gt_labels = clip_batch_boxes(
+        gt_boxes, gt_labels, [img_h, img_w], min_box_size
+    )
+
+    return image, gt_boxes, gt_labels
+
+
+def mixup_batch(image, gt_boxes, gt_labels, alpha=8.0, seed=None):
+    if seed is None:
+        gamma = tf.random.gamma([2], alpha)
+    else:
+        gamma = tf.random.stateless_gamma([2], seed, alpha)
+    ratio = gamma[0] / (gamma[0] + gamma[1])
+    mixed_image = ratio * tf.cast(image, tf.float32) + (1.0 - ratio) * tf.cast(
+        tf.roll(image, 1, axis=0), tf.float32
+    )
+    if image.dtype == tf.uint8:
+        mixed_image = tf.cast(tf.round(mixed_image), dtype=tf.uint8)
+    image = mixed_image
+    gt_boxes = tf.concat([gt_boxes, tf.roll(gt_boxes, 1, axis=0)], axis=1)
+    gt_labels = tf.concat([gt_labels, tf.roll(gt_labels, 1, axis=0)], axis=1)
+
     return image, gt_boxes, gt_labels
+
+
+def clip_batch_boxes(gt_boxes, gt_labels, img_size, min_box_size):
+    img_scale = tf.constant(list(img_size) * 2, dtype=tf.float32)
+    gt_boxes = tf.clip_by_value(gt_boxes, 0.0, img_scale)
+    box_h = gt_boxes[..., 2] - gt_boxes[..., 0]
+    box_w = gt_boxes[..., 3] - gt_boxes[..., 1]
+    valid = tf.logical_and(
+        tf.not_equal(gt_labels, -1),
+        tf.logical_and(box_h >= min_box_size, box_w >= min_box_size),
+    )
+    gt_boxes = tf.where(tf.expand_dims(valid, -1), gt_boxes / img_scale, 0.0)
+    gt_labels = tf.where(valid, gt_labels, -1)
+
+    return gt_boxes, gt_labels
@@ -0,0 +1,36 @@
+import json
+import tensorflow as tf
+
+
+def build_strategy(multi_worker=False):
+    if multi_worker:
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    else:
+        strategy = tf.distribute.MirroredStrategy()
+
+    return strategy
+
+
+def is_chief(strategy):
+    cluster_resolver = getattr(strategy, "cluster_resolver", None)
+    if cluster_resolver is None or not cluster_resolver.cluster_spec().as_dict():
+        return True
+    task_type, task_id = cluster_resolver.task_type, cluster_resolver.task_id
+
+    return task_type == "chief" or (task_type == "worker" and task_id == 0)
+
+
+def sync_workers(strategy):
+    ones = strategy.run(lambda: tf.ones([]))
+    strategy.reduce(tf.distribute.ReduceOp.SUM, ones, axis=None).numpy()
+
+
+def build_tf_config(num_workers, task_id, host="localhost", base_port=12345):
+    tf_config = {
+        "cluster": {
+            "worker": [f"{host}:{base_port + worker}" for worker in range(num_workers)]
+        },
+        "task": {"type": "worker", "index": task_id},
+    }
+
+    return json.dumps(tf_config)
@@ -0,0 +1,121 @@
+import os
+import csv
+import json
+import queue
+import threading
+import tensorflow as tf
+
+LOSS_NAMES = ("yx_loss", "hw_loss", "obj_loss", "nobj_loss", "cls_loss")
+
+
+class NeptuneBackend:
+    def __init__(self, run):
+        self.run = run
+
+    def write(self, step, metrics):
+        for key, value in metrics.items():
+            self.run[key].log(value, step=step)
+
+    def close(self):
+        pass
+
+
+class JsonlBackend:
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, step, metrics):
+        self.file.write(json.dumps({"step": step, **metrics}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CsvBackend:
+    def __init__(self, path):
+        self.file = open(path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:
+            self.writer.writerow(["step", "key", "value"])
+
+    def write(self, step, metrics):
+        for key, value in metrics.items():
+            self.writer.writerow([step, key, value])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MetricSink:
+    def __init__(self, backends, log_every=50):
+        self.backends = backends
+        self.log_every = log_every
+        self.latest = {}
+        self.loss_sum = None
+        self.loss_count = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def update(self, step, loss, count=1):
+        loss = loss * count
+        self.loss_sum = loss if self.loss_sum is None else self.loss_sum + loss
+        self.loss_count += count
+        if self.loss_count >= self.log_every:
+            self.flush(step)
+
+    def flush(self, step):
+        if self.loss_sum is None:
+            return
+        mean_loss = self.loss_sum / self.loss_count
+        metrics = {
+            f"train/loss/{name}": mean_loss[i] for i, name in enumerate(LOSS_NAMES)
+        }
+        metrics["train/loss/total_loss"] = tf.reduce_sum(mean_loss)
+        self.queue.put((step, metrics))
+        self.loss_sum, self.loss_count = None, 0
+
+    def log(self, step, metrics):
+        self.queue.put((step, metrics))
+
+    def drain(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            step, metrics = item
+            metrics = {key: float(value) for key, value in metrics.items()}
+            self.latest.update(metrics)
+            for backend in self.backends:
+                backend.write(step, metrics)
+
+    def close(self, step):
+        self.flush(step)
+        self.queue.put(None)
+        self.thread.join()
+        for backend in self.backends:
+            backend.close()
+
+
+def build_metric_sink(run, log_dir, log_name, log_backends, log_every=50):
+    backends = []
+    if "neptune" in log_backends and run is not None:
+        backends.append(NeptuneBackend(run))
+    if "jsonl" in log_backends:
+        os.makedirs(log_dir, exist_ok=True)
+        backends.append(JsonlBackend(f"{log_dir}/{log_name}_metrics.jsonl"))
+    if "csv" in log_backends:
+        os.makedirs(log_dir, exist_ok=True)
+        backends.append(CsvBackend(f"{log_dir}/{log_name}_metrics.csv"))
+
+    return MetricSink(backends, log_every)
+
+
+def format_latest(latest):
+    return ", ".join(
+        f"{key.split('/')[-1].replace('_loss', '')} {value:.4f}"
+        for key, value in latest.items()
+        if key.startswith("train/loss/")
+    )
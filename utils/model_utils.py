@@ -13,18 +13,19 @@ from tensorflow.keras.layers import (
     Concatenate,
     Reshape,
     Add,
-    Multiply,
-    Activation,
+    Layer,
 )
 from .bbox_utils import delta_to_bbox
 
 
-def yolo_v3(
-    input_shape, labels, offset_grids, prior_grids, data_dir, fine_tunning=True
-):
+def yolo_v3(input_shape, labels, data_dir, fine_tunning=True, remat=None):
     base_model = DarkNet53(include_top=False, input_shape=input_shape)
     weights_dir = f"{data_dir}/darknet_weights/weights"
     base_model.load_weights(weights_dir)  #
+    if remat is not None:
+        remat_model = DarkNet53(include_top=False, input_shape=input_shape, remat=remat)
+        transfer_weights(base_model, remat_model)
+        base_model = remat_model
     if fine_tunning == False:
         base_model.trainable = False
 
@@ -78,6 +79,7 @@ def yolo_v3(
             },
         ],
         skip=False,
+        remat=remat is not None,
     )
 
     head1 = conv_block(
@@ -165,6 +167,7 @@ def yolo_v3(
             },
         ],
         skip=False,
+        remat=remat is not None,
     )
 
     head2 = conv_block(
@@ -252,6 +255,7 @@ def yolo_v3(
             },
         ],
         skip=False,
+        remat=remat is not None,
     )
 
     head3 = conv_block(
@@ -277,145 +281,143 @@ def yolo_v3(
         skip=False,
     )
 
-    outputs = yolo_head([head1, head2, head3], offset_grids, prior_grids)
+    outputs = Concatenate(axis=1, dtype="float32")(
+        [
+            Reshape(target_shape=(-1, 5 + total_labels))(head)
+            for head in (head1, head2, head3)
+        ]
+    )
 
     return Model(inputs=inputs, outputs=outputs)
 
 
-def DarkNet53(include_top=True, input_shape=(None, None, 3)):
+def DarkNet53(include_top=True, input_shape=(None, None, 3), remat=None):
     input_x = Input(shape=input_shape)
+    block_remat = remat == "block"
+    stage_remat = remat == "stage"
 
-    x = conv_block(
-        input_x,
-        [
-            {
-                "filter": 32,
-                "kernel": 3,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 0,
-            },
-            {
-                "filter": 64,
-                "kernel": 3,
-                "stride": 2,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 1,
-            },
-            {
-                "filter": 32,
-                "kernel": 1,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 2,
-            },
-            {
-                "filter": 64,
-                "kernel": 3,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 3,
-            },
-        ],
-    )
+    def stage_1(x):
+        x = conv_block(
+            x,
+            [
+                {
+                    "filter": 32,
+                    "kernel": 3,
+                    "stride": 1,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 0,
+                },
+                {
+                    "filter": 64,
+                    "kernel": 3,
+                    "stride": 2,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 1,
+                },
+                {
+                    "filter": 32,
+                    "kernel": 1,
+                    "stride": 1,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 2,
+                },
+                {
+                    "filter": 64,
+                    "kernel": 3,
+                    "stride": 1,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 3,
+                },
+            ],
+            remat=block_remat,
+        )
 
-    x = conv_block(
-        x,
-        [
-            {
-                "filter": 128,
-                "kernel": 3,
-                "stride": 2,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 5,
-            },
-            {
-                "filter": 64,
-                "kernel": 1,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 6,
-            },
-            {
-                "filter": 128,
-                "kernel": 3,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 7,
-            },
-        ],
-    )
+        return x
 
-    x = conv_block(
-        x,
-        [
-            {
-                "filter": 64,
-                "kernel": 1,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 9,
-            },
-            {
-                "filter": 128,
-                "kernel": 3,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 10,
-            },
-        ],
-    )
+    x = remat_block(input_x, stage_1, "stage_1", stage_remat)
 
-    x = conv_block(
-        x,
-        [
-            {
-                "filter": 256,
-                "kernel": 3,
-                "stride": 2,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 12,
-            },
-            {
-                "filter": 128,
-                "kernel": 1,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 13,
-            },
-            {
-                "filter": 256,
-                "kernel": 3,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 14,
-            },
-        ],
-    )
+    def stage_2(x):
+        x = conv_block(
+            x,
+            [
+                {
+                    "filter": 128,
+                    "kernel": 3,
+                    "stride": 2,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 5,
+                },
+                {
+                    "filter": 64,
+                    "kernel": 1,
+                    "stride": 1,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 6,
+                },
+                {
+                    "filter": 128,
+                    "kernel": 3,
+                    "stride": 1,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 7,
+                },
+            ],
+            remat=block_remat,
+        )
+
+        x = conv_block(
+            x,
+            [
+                {
+                    "filter": 64,
+                    "kernel": 1,
+                    "stride": 1,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 9,
+                },
+                {
+                    "filter": 128,
+                    "kernel": 3,
+                    "stride": 1,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 10,
+                },
+            ],
+            remat=block_remat,
+        )
+
+        return x
+
+    x = remat_block(x, stage_2, "stage_2", stage_remat)
 
-    for i in range(7):
+    def stage_3(x):
         x = conv_block(
             x,
             [
+                {
+                    "filter": 256,
+                    "kernel": 3,
+                    "stride": 2,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 12,
+                },
                 {
                     "filter": 128,
                     "kernel": 1,
                     "stride": 1,
                     "bnorm": True,
                     "leaky": True,
-                    "layer_idx": 16 + i * 3,
+                    "layer_idx": 13,
                 },
                 {
                     "filter": 256,
@@ -423,53 +425,60 @@ def DarkNet53(include_top=True, input_shape=(None, None, 3)):
                     "stride": 1,
                     "bnorm": True,
                     "leaky": True,
-                    "layer_idx": 17 + i * 3,
+                    "layer_idx": 14,
                 },
             ],
+            remat=block_remat,
         )
-    c3 = x
 
-    x = conv_block(
-        x,
-        [
-            {
-                "filter": 512,
-                "kernel": 3,
-                "stride": 2,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 37,
-            },
-            {
-                "filter": 256,
-                "kernel": 1,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 38,
-            },
-            {
-                "filter": 512,
-                "kernel": 3,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 39,
-            },
-        ],
-    )
+        for i in range(7):
+            x = conv_block(
+                x,
+                [
+                    {
+                        "filter": 128,
+                        "kernel": 1,
+                        "stride": 1,
+                        "bnorm": True,
+                        "leaky": True,
+                        "layer_idx": 16 + i * 3,
+                    },
+                    {
+                        "filter": 256,
+                        "kernel": 3,
+                        "stride": 1,
+                        "bnorm": True,
+                        "leaky": True,
+                        "layer_idx": 17 + i * 3,
+                    },
+                ],
+                remat=block_remat,
+            )
+
+        return x
+
+    x = remat_block(x, stage_3, "stage_3", stage_remat)
+    c3 = x
 
-    for i in range(7):
+    def stage_4(x):
         x = conv_block(
             x,
             [
+                {
+                    "filter": 512,
+                    "kernel": 3,
+                    "stride": 2,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 37,
+                },
                 {
                     "filter": 256,
                     "kernel": 1,
                     "stride": 1,
                     "bnorm": True,
                     "leaky": True,
-                    "layer_idx": 41 + i * 3,
+                    "layer_idx": 38,
                 },
                 {
                     "filter": 512,
@@ -477,53 +486,60 @@ def DarkNet53(include_top=True, input_shape=(None, None, 3)):
                     "stride": 1,
                     "bnorm": True,
                     "leaky": True,
-                    "layer_idx": 42 + i * 3,
+                    "layer_idx": 39,
                 },
             ],
+            remat=block_remat,
         )
-    c2 = x
 
-    x = conv_block(
-        x,
-        [
-            {
-                "filter": 1024,
-                "kernel": 3,
-                "stride": 2,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 62,
-            },
-            {
-                "filter": 512,
-                "kernel": 1,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 63,
-            },
-            {
-                "filter": 1024,
-                "kernel": 3,
-                "stride": 1,
-                "bnorm": True,
-                "leaky": True,
-                "layer_idx": 64,
-            },
-        ],
-    )
+        for i in range(7):
+            x = conv_block(
+                x,
+                [
+                    {
+                        "filter": 256,
+                        "kernel": 1,
+                        "stride": 1,
+                        "bnorm": True,
+                        "leaky": True,
+                        "layer_idx": 41 + i * 3,
+                    },
+                    {
+                        "filter": 512,
+                        "kernel": 3,
+                        "stride": 1,
+                        "bnorm": True,
+                        "leaky": True,
+                        "layer_idx": 42 + i * 3,
+                    },
+                ],
+                remat=block_remat,
+            )
+
+        return x
+
+    x = remat_block(x, stage_4, "stage_4", stage_remat)
+    c2 = x
 
-    for i in range(3):
+    def stage_5(x):
         x = conv_block(
             x,
             [
+                {
+                    "filter": 1024,
+                    "kernel": 3,
+                    "stride": 2,
+                    "bnorm": True,
+                    "leaky": True,
+                    "layer_idx": 62,
+                },
                 {
                     "filter": 512,
                     "kernel": 1,
                     "stride": 1,
                     "bnorm": True,
                     "leaky": True,
-                    "layer_idx": 66 + i * 3,
+                    "layer_idx": 63,
                 },
                 {
                     "filter": 1024,
@@ -531,10 +547,39 @@ def DarkNet53(include_top=True, input_shape=(None, None, 3)):
                     "stride": 1,
                     "bnorm": True,
                     "leaky": True,
-                    "layer_idx": 67 + i * 3,
+                    "layer_idx": 64,
                 },
             ],
+            remat=block_remat,
         )
+
+        for i in range(3):
+            x = conv_block(
+                x,
+                [
+                    {
+                        "filter": 512,
+                        "kernel": 1,
+                        "stride": 1,
+                        "bnorm": True,
+                        "leaky": True,
+                        "layer_idx": 66 + i * 3,
+                    },
+                    {
+                        "filter": 1024,
+                        "kernel": 3,
+                        "stride": 1,
+                        "bnorm": True,
+                        "leaky": True,
+                        "layer_idx": 67 + i * 3,
+                    },
+                ],
+                remat=block_remat,
+            )
+
+        return x
+
+    x = remat_block(x, stage_5, "stage_5", stage_remat)
     c1 = x
 
     if include_top == False:
@@ -545,7 +590,13 @@ def DarkNet53(include_top=True, input_shape=(None, None, 3)):
     return Model(inputs=input_x, outputs=output_x)
 
 
-def conv_block(inp, convs, skip=True):
+def conv_block(inp, convs, skip=True, remat=False):
+    if remat:
+        return remat_block(
+            inp,
+            lambda x: conv_block(x, convs, skip),
+            f"block_{convs[0]['layer_idx']}",
+        )
     x = inp
     count = 0
     for conv in convs:
@@ -576,27 +627,64 @@ def conv_block(inp, convs, skip=True):
     return Add()([skip_connection, x]) if skip else x
 
 
-def yolo_head(inputs, offset_grids, prior_grids):
-    head1, head2, head3 = inputs
-    x = Concatenate(axis=1)(
-        [
-            Reshape(target_shape=(13 * 13 * 3, -1))(head1),
-            Reshape(target_shape=(26 * 26 * 3, -1))(head2),
-            Reshape(target_shape=(52 * 52 * 3, -1))(head3),
-        ]
-    )
-    outputs = [
-        Add()(
-            [
-                tf.nn.sigmoid(x[..., :2]),
-                tf.broadcast_to(offset_grids, tf.shape(x[..., :2])),
+def remat_block(inp, build_fn, name, remat=True):
+    if not remat:
+        return build_fn(inp)
+    block_input = Input(shape=inp.shape[1:])
+    block = Model(inputs=block_input, outputs=build_fn(block_input), name=name)
+
+    return RecomputeBlock(block, name=f"{name}_remat")(inp)
+
+
+class RecomputeBlock(Layer):
+    def __init__(self, block, **kwargs):
+        super(RecomputeBlock, self).__init__(**kwargs)
+        self.block = block
+
+    def call(self, x, training=None):
+        passes = []
+
+        @tf.recompute_grad
+        def forward(x):
+            if not passes:
+                passes.append(x)
+                return self.block(x, training=training)
+            # the backward recomputation must not update BatchNorm statistics again
+            moving_stats = [
+                tf.identity(weight) for weight in self.block.non_trainable_weights
             ]
-        ),
-        Multiply()(
-            [tf.exp(x[..., 2:4]), tf.broadcast_to(prior_grids, tf.shape(x[..., 2:4]))]
-        ),
-        Activation("sigmoid")(x[..., 4:5]),
-        Activation("sigmoid")(x[..., 5:]),
+            x = self.block(x, training=training)
+            for weight, value in zip(self.block.non_trainable_weights, moving_stats):
+                weight.assign(value)
+
+            return x
+
+        return forward(x)
+
+
+def collect_layers(model):
+    layers = {}
+    for layer in model.layers:
+        if isinstance(layer, RecomputeBlock):
+            layers.update(collect_layers(layer.block))
+        elif layer.weights:
+            layers[layer.name] = layer
+
+    return layers
+
+
+def transfer_weights(source, target):
+    target_layers = collect_layers(target)
+    for name, layer in collect_layers(source).items():
+        target_layers[name].set_weights(layer.get_weights())
+
+
+def yolo_head(x, offset_grids, prior_grids):
+    outputs = [
+        tf.nn.sigmoid(x[..., :2]) + offset_grids,
+        tf.exp(x[..., 2:4]) * prior_grids,
+        tf.nn.sigmoid(x[..., 4:5]),
+        tf.nn.sigmoid(x[..., 5:]),
     ]
 
     return outputs
@@ -605,18 +693,26 @@ def yolo_head(inputs, offset_grids, prior_grids):
 def decode_pred(
     pred,
     stride_grids,
-    batch_size=1,
+    img_size,
+    batch_size=None,
     max_total_size=200,
     iou_threshold=0.5,
     score_threshold=0.7,
 ):
     pred_yx, pred_hw, pred_obj, pred_cls = pred
-    pred_bboxes = delta_to_bbox(pred_yx, pred_hw, stride_grids)
+    pred_bboxes = delta_to_bbox(pred_yx, pred_hw, stride_grids, img_size)
 
+    if batch_size is None:
+        batch_size = tf.shape(pred_yx)[0]
     pred_bboxes = tf.reshape(pred_bboxes, (batch_size, -1, 1, 4))
     pred_labels = pred_cls * pred_obj
 
-    final_bboxes, final_scores, final_labels, _ = tf.image.combined_non_max_suppression(
+    (
+        final_bboxes,
+        final_scores,
+        final_labels,
+        valid_detections,
+    ) = tf.image.combined_non_max_suppression(
         pred_bboxes,
         pred_labels,
         max_output_size_per_class=max_total_size,
@@ -625,4 +721,4 @@ def decode_pred(
         score_threshold=score_threshold,
     )
 
-    return final_bboxes, final_labels, final_scores
+    return final_bboxes, final_labels, final_scores, valid_detections
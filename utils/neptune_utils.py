@@ -6,6 +6,7 @@ try:
 except:
     subprocess.check_call([sys.executable, "-m", "pip", "install", "neptune-client"])
     import neptune.new as neptune
+from .result_utils import build_ap_metrics
 
 
 def plugin_neptune(NEPTUNE_API_KEY, NEPTUNE_PROJECT, args):
@@ -22,6 +23,8 @@ def plugin_neptune(NEPTUNE_API_KEY, NEPTUNE_PROJECT, args):
 
 
 def record_train_loss(run, loss, total_loss):
+    if run is None:
+        return
     run["train/loss/yx_loss"].log(loss[0].numpy())
     run["train/loss/hw_loss"].log(loss[1].numpy())
     run["train/loss/obj_loss"].log(loss[2].numpy())
@@ -30,11 +33,16 @@ def record_train_loss(run, loss, total_loss):
     run["train/loss/total_loss"].log(total_loss.numpy())
 
 
-def record_result(run, weights_dir, mean_ap, train_time, mean_test_time):
+def record_result(run, weights_dir, aps, train_time, mean_test_time):
     res = {
-        "mean_ap": "%.3f" % (mean_ap.numpy()),
-        "train_time": train_time,
-        "inference_time": "%.2fms" % (mean_test_time.numpy()),
+        key: "%.3f" % (mean_ap)
+        for key, mean_ap in build_ap_metrics(aps, "mean_ap").items()
     }
+    res.update(
+        {
+            "train_time": train_time,
+            "inference_time": "%.2fms" % (mean_test_time.numpy()),
+        }
+    )
     run["results"] = res
     run["model"].upload(weights_dir)
@@ -11,9 +11,16 @@ except:
     import tensorflow_addons as tfa
 
 from .loss_utils import loss_fn
+from .target_utils import build_target
+from .model_utils import yolo_head
+from .data_utils import rescale_image
 
 
-def build_optimizer(batch_size, data_num):
+def set_precision(precision):
+    tf.keras.mixed_precision.set_global_policy(precision)
+
+
+def build_optimizer(batch_size, data_num, precision="float32"):
     boundaries = [data_num // batch_size * epoch for epoch in (10, 60, 90)]
     # values = [1e-3, 1e-4, 1e-5, 1e-6]
     values = [1e-4, 1e-5, 1e-6, 1e-7]
@@ -22,20 +29,263 @@ def build_optimizer(batch_size, data_num):
     optimizer = tfa.optimizers.AdamW(
         learning_rate=lr_fn, weight_decay=tf.constant(0.0005)
     )
+    if precision == "mixed_float16":
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
 
     return optimizer
 
 
-@tf.function
-def forward_backward(image, true, model, optimizer, batch_size, lambda_lst):
-    with tf.GradientTape(persistent=True) as tape:
-        pred = model(image)
+def compute_gradients(
+    image,
+    true,
+    model,
+    optimizer,
+    batch_size,
+    lambda_lst,
+    offset_grids,
+    prior_grids,
+    img_size=None,
+):
+    image = rescale_image(image)
+    if img_size is not None:
+        image = tf.image.resize(image, img_size)
+    with tf.GradientTape() as tape:
+        pred = yolo_head(model(image), offset_grids, prior_grids)
         loss = loss_fn(
             pred=pred, true=true, batch_size=batch_size, lambda_lst=lambda_lst
         )
         total_loss = tf.reduce_sum(loss)
+        if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            total_loss = optimizer.get_scaled_loss(total_loss)
 
     grads = tape.gradient(total_loss, model.trainable_weights)
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        grads = optimizer.get_unscaled_gradients(grads)
+
+    return loss, grads
+
+
+def forward_backward(
+    image,
+    true,
+    model,
+    optimizer,
+    batch_size,
+    lambda_lst,
+    offset_grids,
+    prior_grids,
+    img_size=None,
+):
+    loss, grads = compute_gradients(
+        image,
+        true,
+        model,
+        optimizer,
+        batch_size,
+        lambda_lst,
+        offset_grids,
+        prior_grids,
+        img_size,
+    )
     optimizer.apply_gradients(zip(grads, model.trainable_weights))
 
     return loss
+
+
+def build_accumulator(model):
+    accumulator = [
+        tf.Variable(
+            tf.zeros_like(weight),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.SUM,
+        )
+        for weight in model.trainable_weights
+    ]
+
+    return accumulator
+
+
+def accumulate_gradients(
+    image,
+    true,
+    model,
+    optimizer,
+    accumulator,
+    batch_size,
+    lambda_lst,
+    offset_grids,
+    prior_grids,
+    img_size=None,
+):
+    loss, grads = compute_gradients(
+        image,
+        true,
+        model,
+        optimizer,
+        batch_size,
+        lambda_lst,
+        offset_grids,
+        prior_grids,
+        img_size,
+    )
+    for accum_grad, grad in zip(accumulator, grads):
+        accum_grad.assign_add(grad)
+
+    return loss
+
+
+def apply_accumulated(model, optimizer, accumulator, accum_steps):
+    grads = [accum_grad / accum_steps for accum_grad in accumulator]
+    optimizer.apply_gradients(zip(grads, model.trainable_weights))
+    for accum_grad in accumulator:
+        accum_grad.assign(tf.zeros_like(accum_grad))
+
+
+def build_ema(model):
+    ema_weights = [
+        tf.Variable(
+            weight.read_value(),
+            trainable=False,
+            aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA,
+        )
+        for weight in model.weights
+    ]
+
+    return ema_weights
+
+
+def update_ema(model, ema_weights, ema_decay, step):
+    step = tf.cast(step, dtype=tf.float32)
+    decay = tf.minimum(ema_decay, (1.0 + step) / (10.0 + step))
+    for ema_weight, weight in zip(ema_weights, model.weights):
+        ema_weight.assign(decay * ema_weight + (1.0 - decay) * weight)
+
+
+def swap_ema(model, ema_weights):
+    for ema_weight, weight in zip(ema_weights, model.weights):
+        value = tf.identity(weight)
+        weight.assign(ema_weight)
+        ema_weight.assign(value)
+
+
+def build_train_step(
+    strategy,
+    model,
+    optimizer,
+    anchor_ops,
+    labels,
+    lambda_lst,
+    batch_size,
+    img_size,
+    ignore_threshold=0.5,
+    encode_target=True,
+    resize=False,
+    accumulator=None,
+    accum_steps=1,
+    ema_weights=None,
+    ema_decay=0.9999,
+    profiler=None,
+):
+    anchors, prior_grids, offset_grids, stride_grids = anchor_ops
+
+    def target_fn(batch):
+        image, gt_boxes, gt_labels = batch
+        true = build_target(
+            anchors,
+            gt_boxes,
+            gt_labels,
+            labels,
+            img_size,
+            stride_grids,
+            ignore_threshold,
+        )
+        return image, true
+
+    def update_fn(image, true):
+        if accumulator is None:
+            loss = forward_backward(
+                image,
+                true,
+                model,
+                optimizer,
+                batch_size,
+                lambda_lst,
+                offset_grids,
+                prior_grids,
+                img_size if resize else None,
+            )
+        else:
+            loss = accumulate_gradients(
+                image,
+                true,
+                model,
+                optimizer,
+                accumulator,
+                batch_size,
+                lambda_lst,
+                offset_grids,
+                prior_grids,
+                img_size if resize else None,
+            )
+        return tf.stack(loss)
+
+    def finish_fn():
+        if accumulator is not None:
+            apply_accumulated(model, optimizer, accumulator, accum_steps)
+        if ema_weights is not None:
+            update_ema(model, ema_weights, ema_decay, optimizer.iterations)
+
+    def step_fn(batch):
+        image, true = target_fn(batch) if encode_target else batch
+        return update_fn(image, true)
+
+    @tf.function
+    def train_step(iterator, executions):
+        loss = tf.zeros([5])
+        for _ in tf.range(executions):
+            for _ in tf.range(accum_steps):
+                replica_loss = strategy.run(step_fn, args=(next(iterator),))
+                loss += strategy.reduce(
+                    tf.distribute.ReduceOp.MEAN, replica_loss, axis=None
+                )
+            if accumulator is not None or ema_weights is not None:
+                strategy.run(finish_fn)
+
+        return loss / (executions * accum_steps)
+
+    if profiler is None or not profiler.enabled:
+        return train_step
+
+    target_step = tf.function(lambda batch: strategy.run(target_fn, args=(batch,)))
+    update_step = tf.function(
+        lambda image, true: strategy.run(update_fn, args=(image, true))
+    )
+    reduce_step = tf.function(
+        lambda loss: strategy.reduce(tf.distribute.ReduceOp.MEAN, loss, axis=None)
+    )
+    finish_step = tf.function(lambda: strategy.run(finish_fn))
+
+    def staged_step(iterator, executions):
+        loss = tf.zeros([5])
+        for _ in range(executions):
+            for _ in range(accum_steps):
+                with profiler.stage("input"):
+                    batch = profiler.wait(strategy, next(iterator))
+                if encode_target:
+                    with profiler.stage("target"):
+                        image, true = profiler.wait(strategy, target_step(batch))
+                else:
+                    image, true = batch
+                with profiler.stage("forward_backward"):
+                    replica_loss = profiler.wait(strategy, update_step(image, true))
+                with profiler.stage("reduce"):
+                    loss += profiler.wait(strategy, reduce_step(replica_loss))
+            if accumulator is not None or ema_weights is not None:
+                with profiler.stage("apply"):
+                    finish_step()
+                    profiler.wait(strategy, optimizer.iterations)
+
+        return loss / (executions * accum_steps)
+
+    return staged_step
@@ -1,39 +1,64 @@
 import os
 import time
+import random
 import tensorflow as tf
 import neptune.new as neptune
 from tqdm import tqdm
 from . import (
     gpu_memory_growth,
+    build_dataset,
+    build_iterator,
+    rescale_image,
+    load_target_cache,
     load_box_prior,
-    build_anchor_ops,
+    build_anchor_table,
     build_target,
     yolo_v3,
+    yolo_head,
+    set_precision,
     build_optimizer,
-    forward_backward,
-    build_args,
+    build_accumulator,
+    build_ema,
+    swap_ema,
+    build_train_step,
     build_lambda,
     plugin_neptune,
-    record_train_loss,
+    build_metric_sink,
+    format_latest,
+    StageProfiler,
     decode_pred,
     draw_output,
-    calculate_ap_const,
+    MeanAveragePrecision,
+    build_eval_pool,
+    MetricConsumer,
+    build_ap_metrics,
+    format_aps,
     record_result,
+    is_chief,
+    sync_workers,
+    AsyncCheckpoint,
+    load_ckpt_step,
+    load_ckpt_weights,
+    clear_eval_markers,
+    load_external_weights,
 )
 
 
-def initialize_process(NEPTUNE_API_KEY, NEPTUNE_PROJECT):
-    args = build_args()
+def initialize_process(NEPTUNE_API_KEY, NEPTUNE_PROJECT, args, strategy):
     os.makedirs(f"{args.data_dir}/data_chkr", exist_ok=True)
-    run = plugin_neptune(NEPTUNE_API_KEY, NEPTUNE_PROJECT, args)
-
-    experiment_name = run.get_run_url().split("/")[-1].replace("-", "_")
     model_name = NEPTUNE_PROJECT.split("-")[-1]
     experiment_dir = f"./model_weights/{model_name}"
     os.makedirs(experiment_dir, exist_ok=True)
+
+    if is_chief(strategy):
+        run = plugin_neptune(NEPTUNE_API_KEY, NEPTUNE_PROJECT, args)
+        experiment_name = run.get_run_url().split("/")[-1].replace("-", "_")
+    else:
+        run = None
+        experiment_name = f"worker_{strategy.cluster_resolver.task_id}"
     weights_dir = f"{experiment_dir}/{experiment_name}.h5"
 
-    return args, run, weights_dir
+    return run, weights_dir
 
 
 def run_process(
@@ -43,30 +68,139 @@ def run_process(
     valid_num,
     test_num,
     run,
-    train_set,
-    valid_set,
-    test_set,
+    datasets,
     weights_dir,
     strategy,
 ):
     lambda_lst = build_lambda(args)
+    _, valid_set, test_set = build_dataset(
+        datasets,
+        args.batch_size,
+        args.img_size,
+        rescale=not args.image_store,
+        eval_batch_size=args.eval_batch_size,
+    )
     box_priors = load_box_prior(
-        train_set, args.name, args.data_dir, args.img_size, train_num
+        args.name,
+        args.data_dir,
+        args.img_size,
+        kmeans_batch_size=args.kmeans_batch_size,
+        kmeans_workers=args.kmeans_workers,
     )
-    anchors, prior_grids, offset_grids, stride_grids = build_anchor_ops(
-        args.img_size, box_priors
+    if args.multi_scale and (args.target_in_pipeline or args.target_cache):
+        raise ValueError(
+            "--multi-scale builds targets per batch resolution on the device "
+            "and cannot be combined with --target-in-pipeline or --target-cache"
+        )
+    if args.resume and args.ckpt_dir is None:
+        raise ValueError(
+            "--resume needs the --ckpt-dir of the interrupted run, shared by all workers"
+        )
+    if any(scale % 32 for scale in args.multi_scale):
+        raise ValueError("--multi-scale resolutions must be multiples of 32")
+    train_img_size = [max([size] + args.multi_scale) for size in args.img_size]
+    if args.image_store and train_img_size != args.img_size:
+        raise ValueError(
+            "--image-store keeps images at --img-size, so --multi-scale "
+            "resolutions must not exceed it"
+        )
+    if args.steps_per_execution * args.accum_steps > train_num // args.batch_size:
+        raise ValueError(
+            "--steps-per-execution * --accum-steps must not exceed the "
+            f"{train_num // args.batch_size} steps of an epoch"
+        )
+    img_sizes = [args.img_size] + [[scale, scale] for scale in args.multi_scale]
+    anchor_table = build_anchor_table(img_sizes, box_priors, args.img_size)
+    anchors, prior_grids, offset_grids, stride_grids = anchor_table[
+        tuple(args.img_size)
+    ]
+
+    ckpt_dir = args.ckpt_dir or f"{os.path.splitext(weights_dir)[0]}_ckpt"
+    start_step = load_ckpt_step(ckpt_dir) if args.resume else 0
+    if args.eval_mode == "external" and is_chief(strategy):
+        clear_eval_markers(ckpt_dir, args.resume)
+
+    def dataset_fn(input_context):
+        batch_size = input_context.get_per_replica_batch_size(args.batch_size)
+        skip_samples = start_step * args.batch_size // input_context.num_input_pipelines
+        shard_num = len(
+            range(
+                input_context.input_pipeline_id,
+                train_num,
+                input_context.num_input_pipelines,
+            )
+        )
+        if args.target_cache:
+            train_set = load_target_cache(
+                datasets[0],
+                args.name,
+                args.data_dir,
+                batch_size,
+                args.img_size,
+                box_priors,
+                anchors,
+                stride_grids,
+                labels,
+                args.ignore_threshold,
+                input_context=input_context,
+                skip_samples=skip_samples,
+                deterministic=True,
+                seed=args.seed,
+            )
+            return train_set
+        train_set, _, _ = build_dataset(
+            datasets,
+            batch_size,
+            train_img_size,
+            args.mosaic_prob,
+            args.mixup_prob,
+            rescale=not args.image_store,
+            input_context=input_context,
+            skip_samples=skip_samples % max(shard_num, 1),
+            deterministic=True,
+            seed=args.seed,
+            start_index=skip_samples,
+        )
+        return train_set
+
+    if is_chief(strategy):
+        if args.target_cache:
+            dataset_fn(tf.distribute.InputContext())
+        sync_workers(strategy)
+
+    target_fn = None
+    if args.target_in_pipeline:
+        target_fn = lambda gt_boxes, gt_labels: build_target(
+            anchors,
+            gt_boxes,
+            gt_labels,
+            labels,
+            args.img_size,
+            stride_grids,
+            args.ignore_threshold,
+        )
+    train_set, valid_set, test_set = build_iterator(
+        (dataset_fn, valid_set, test_set), strategy, target_fn
     )
 
+    set_precision(args.precision)
     with strategy.scope():
         model = yolo_v3(
-            args.img_size + [3],
+            [None, None, 3] if args.multi_scale else args.img_size + [3],
             labels,
-            offset_grids,
-            prior_grids,
             args.data_dir,
             fine_tunning=True,
+            remat=args.remat,
+        )
+        optimizer = build_optimizer(
+            args.batch_size * args.accum_steps, train_num, args.precision
         )
-        optimizer = build_optimizer(args.batch_size, train_num)
+        optimizer._create_all_weights(model.trainable_weights)
+        ema_weights = build_ema(model) if args.ema_decay > 0 else None
+    eval_pool = build_eval_pool(args.eval_workers)
+    checkpoint = AsyncCheckpoint(
+        model, optimizer, ckpt_dir, is_chief(strategy), ema_weights=ema_weights
+    )
     with strategy.scope():
         train_time = train(
             run,
@@ -76,17 +210,44 @@ def run_process(
             train_set,
             valid_set,
             labels,
-            anchors,
-            stride_grids,
+            anchor_table,
             model,
             optimizer,
             lambda_lst,
             weights_dir,
             strategy,
+            checkpoint,
+            ema_weights,
+            args.resume,
+            eval_pool,
         )
 
-    mean_ap, mean_test_time = test(run, test_num, test_set, model, stride_grids, labels)
-    record_result(run, weights_dir, mean_ap, train_time, mean_test_time)
+    if not is_chief(strategy):
+        if eval_pool is not None:
+            eval_pool.shutdown()
+        return
+
+    if args.eval_mode == "external":
+        weights_dir = load_external_weights(
+            model, ckpt_dir, args.eval_timeout, args.ema_decay > 0
+        )
+    aps, mean_test_time = test(
+        run,
+        test_num,
+        test_set,
+        model,
+        weights_dir,
+        offset_grids,
+        prior_grids,
+        stride_grids,
+        args.img_size,
+        labels,
+        args.map_method,
+        eval_pool,
+    )
+    if eval_pool is not None:
+        eval_pool.shutdown()
+    record_result(run, weights_dir, aps, train_time, mean_test_time)
 
 
 def train(
@@ -97,103 +258,215 @@ def train(
     train_set,
     valid_set,
     labels,
-    anchors,
-    stride_grids,
+    anchor_table,
     model,
     optimizer,
     lambda_lst,
     weights_dir,
     strategy,
+    checkpoint,
+    ema_weights=None,
+    resume=False,
+    eval_pool=None,
 ):
-    best_mean_ap = 0
+    global_step, best_mean_ap = checkpoint.restore() if resume else (0, 0.0)
     start_time = time.time()
+    scales = [[scale, scale] for scale in args.multi_scale]
+    scale_rng = random.Random(args.seed)
+    _, valid_prior_grids, valid_offset_grids, valid_stride_grids = anchor_table[
+        tuple(args.img_size)
+    ]
+
+    sink = build_metric_sink(
+        run,
+        os.path.dirname(weights_dir),
+        os.path.splitext(os.path.basename(weights_dir))[0],
+        args.log_backends,
+        args.log_every,
+    )
+    profiler = StageProfiler(
+        args.profile_stages,
+        f"{os.path.splitext(weights_dir)[0]}_profile.jsonl",
+        args.profile_steps,
+        f"{os.path.splitext(weights_dir)[0]}_trace",
+    )
 
-    for epoch in range(args.epochs):
-        epoch_progress = tqdm(range(train_num // args.batch_size))
-        for _ in epoch_progress:
-            image, gt_boxes, gt_labels = next(train_set)
-            true = strategy.run(
-                build_target,
-                args=(
-                    anchors,
-                    gt_boxes,
-                    gt_labels,
+    train_steps = {}
+    updates_per_epoch = train_num // args.batch_size // args.accum_steps
+    steps_per_epoch = updates_per_epoch * args.accum_steps
+    epoch_calls = [args.steps_per_execution] * (
+        updates_per_epoch // args.steps_per_execution
+    )
+    if updates_per_epoch % args.steps_per_execution:
+        epoch_calls.append(updates_per_epoch % args.steps_per_execution)
+    start_epoch, start_offset = divmod(global_step, steps_per_epoch)
+    first_call = start_offset // (args.steps_per_execution * args.accum_steps)
+    accumulator = build_accumulator(model) if args.accum_steps > 1 else None
+    if scales:
+        for _ in range(start_epoch * len(epoch_calls) + first_call):
+            scale_rng.choice(scales)
+
+    for epoch in range(start_epoch, args.epochs):
+        epoch_progress = tqdm(total=steps_per_epoch)
+        epoch_progress.update(sum(epoch_calls[:first_call]) * args.accum_steps)
+        for executions in epoch_calls[first_call:]:
+            img_size = scale_rng.choice(scales) if scales else args.img_size
+            if tuple(img_size) not in train_steps:
+                train_steps[tuple(img_size)] = build_train_step(
+                    strategy,
+                    model,
+                    optimizer,
+                    anchor_table[tuple(img_size)],
                     labels,
-                    args.img_size,
-                    stride_grids,
-                ),
-            )
-            loss = strategy.run(
-                forward_backward,
-                args=(image, true, model, optimizer, args.batch_size, lambda_lst),
-            )
-            loss = [
-                strategy.reduce(tf.distribute.ReduceOp.MEAN, loss[i], axis=None)
-                for i in range(len(loss))
-            ]
-            total_loss = tf.reduce_sum(loss)
-            record_train_loss(run, loss, total_loss)
-            epoch_progress.set_description(
-                "Epoch {}/{} | yx {:.4f}, hw {:.4f}, obj {:.4f}, nobj {:.4f}, cls {:.4f}, total {:.4f}".format(
-                    epoch + 1,
-                    args.epochs,
-                    loss[0].numpy(),
-                    loss[1].numpy(),
-                    loss[2].numpy(),
-                    loss[3].numpy(),
-                    loss[4].numpy(),
-                    total_loss.numpy(),
+                    lambda_lst,
+                    args.batch_size,
+                    img_size,
+                    args.ignore_threshold,
+                    encode_target=not (args.target_in_pipeline or args.target_cache),
+                    resize=bool(scales),
+                    accumulator=accumulator,
+                    accum_steps=args.accum_steps,
+                    ema_weights=ema_weights,
+                    ema_decay=args.ema_decay,
+                    profiler=profiler,
+                )
+            profiler.trace(global_step)
+            loss = train_steps[tuple(img_size)](train_set, executions)
+            steps_per_call = executions * args.accum_steps
+            global_step += steps_per_call
+            with profiler.stage("logging"):
+                sink.update(global_step, loss, steps_per_call)
+                epoch_progress.update(steps_per_call)
+                epoch_progress.set_description(
+                    "Epoch {}/{} | {}".format(
+                        epoch + 1, args.epochs, format_latest(sink.latest)
+                    )
                 )
+            if (
+                global_step // args.ckpt_every
+                > (global_step - steps_per_call) // args.ckpt_every
+            ):
+                checkpoint.save(global_step, best_mean_ap)
+        first_call = 0
+        epoch_progress.close()
+        profiler.summary(epoch + 1)
+        if args.eval_mode == "inline":
+            if ema_weights is not None:
+                swap_ema(model, ema_weights)
+            aps = validation(
+                valid_set,
+                valid_num,
+                valid_offset_grids,
+                valid_prior_grids,
+                valid_stride_grids,
+                args.img_size,
+                model,
+                labels,
+                strategy,
+                args.map_method,
+                eval_pool,
             )
-        mean_ap = validation(
-            valid_set, valid_num, stride_grids, model, labels, strategy
-        )
 
-        run["validation/mAP"].log(mean_ap.numpy())
+            sink.log(global_step, build_ap_metrics(aps, "validation/mAP"))
 
-        if mean_ap.numpy() > best_mean_ap:
-            best_mean_ap = mean_ap.numpy()
-            model.save_weights(weights_dir)
+            if aps["all"] > best_mean_ap:
+                best_mean_ap = aps["all"]
+                if is_chief(strategy):
+                    model.save_weights(weights_dir)
+            if ema_weights is not None:
+                swap_ema(model, ema_weights)
+        checkpoint.save(global_step, best_mean_ap)
 
+    profiler.close()
+    checkpoint.wait()
+    if args.eval_mode == "external" and is_chief(strategy):
+        with open(f"{checkpoint.manager.directory}/train_done.txt", "w") as f:
+            f.write(str(global_step))
+    sink.close(global_step)
     train_time = time.time() - start_time
 
     return train_time
 
 
-def validation(valid_set, valid_num, stride_grids, model, labels, strategy):
-    aps = []
-    validation_progress = tqdm(range(valid_num))
-    for _ in validation_progress:
-        image, gt_boxes, gt_labels = next(valid_set)
-        pred = model(image)
-        final_bboxes, final_labels, final_scores = decode_pred(pred, stride_grids)
-        ap = calculate_ap_const(final_bboxes, final_labels, gt_boxes, gt_labels, labels)
-        validation_progress.set_description(
-            "Validation | Average_Precision {:.4f}".format(ap)
+def validation(
+    valid_set,
+    valid_num,
+    offset_grids,
+    prior_grids,
+    stride_grids,
+    img_size,
+    model,
+    labels,
+    strategy,
+    map_method="voc07",
+    eval_pool=None,
+):
+    metric = MetricConsumer(MeanAveragePrecision(len(labels), map_method, eval_pool))
+    validation_progress = tqdm(total=valid_num)
+    validation_progress.set_description("Validation")
+    for image, gt_boxes, gt_labels, image_shapes, gt_areas in valid_set:
+        image = rescale_image(image)
+        pred = yolo_head(model(image), offset_grids, prior_grids)
+        detections = decode_pred(pred, stride_grids, img_size)
+        metric.update_batch(
+            [detection.numpy() for detection in detections],
+            (gt_boxes.numpy(), gt_labels.numpy()),
+            image_shapes.numpy(),
+            gt_areas.numpy(),
         )
-        aps.append(ap)
+        validation_progress.update(image.shape[0])
+    validation_progress.close()
 
-    mean_ap = tf.reduce_mean(aps)
+    aps = metric.result()
+    print("Validation | " + format_aps(aps))
 
-    return mean_ap
+    return aps
 
 
-def test(run, test_num, test_set, model, weights_dir, stride_grids, labels):
+def test(
+    run,
+    test_num,
+    test_set,
+    model,
+    weights_dir,
+    offset_grids,
+    prior_grids,
+    stride_grids,
+    img_size,
+    labels,
+    map_method="voc07",
+    eval_pool=None,
+):
     model.load_weights(weights_dir)
 
     test_times = []
-    aps = []
-    test_progress = tqdm(range(test_num))
-    for step in test_progress:
-        image, gt_boxes, gt_labels = next(test_set)
+    metric = MetricConsumer(MeanAveragePrecision(len(labels), map_method, eval_pool))
+    test_progress = tqdm(total=test_num)
+    test_progress.set_description("Test")
+    for step, (image, gt_boxes, gt_labels, image_shapes, gt_areas) in enumerate(
+        test_set
+    ):
+        image = rescale_image(image)
         start_time = time.time()
-        pred = model(image)
-        final_bboxes, final_labels, final_scores = decode_pred(pred, stride_grids)
-        test_time = time.time() - start_time
-        ap = calculate_ap_const(final_bboxes, final_labels, gt_boxes, gt_labels, labels)
-        test_progress.set_description("Test | Average_Precision {:.4f}".format(ap))
-        aps.append(ap)
+        pred = yolo_head(model(image), offset_grids, prior_grids)
+        final_bboxes, final_labels, final_scores, valid_detections = decode_pred(
+            pred, stride_grids, img_size
+        )
+        valid_detections = valid_detections.numpy()
+        test_time = (time.time() - start_time) / image.shape[0]
+        metric.update_batch(
+            (
+                final_bboxes.numpy(),
+                final_labels.numpy(),
+                final_scores.numpy(),
+                valid_detections,
+            ),
+            (gt_boxes.numpy(), gt_labels.numpy()),
+            image_shapes.numpy(),
+            gt_areas.numpy(),
+        )
         test_times.append(test_time)
+        test_progress.update(image.shape[0])
 
         if step <= 20 == 0:
             run["outputs"].log(
@@ -202,7 +475,76 @@ def test(run, test_num, test_set, model, weights_dir, stride_grids, labels):
                 )
             )
 
-    mean_ap = tf.reduce_mean(aps)
+    test_progress.close()
+
+    aps = metric.result()
+    print("Test | " + format_aps(aps))
     mean_test_time = tf.reduce_mean(test_times)
 
-    return mean_ap, mean_test_time
+    return aps, mean_test_time
+
+
+def run_evaluator(NEPTUNE_API_KEY, NEPTUNE_PROJECT, args, labels, valid_num, datasets):
+    if args.ckpt_dir is None:
+        raise ValueError("--evaluator needs the --ckpt-dir of the training job")
+    run = None
+    if "neptune" in args.log_backends:
+        run = plugin_neptune(NEPTUNE_API_KEY, NEPTUNE_PROJECT, args)
+    _, valid_set, _ = build_dataset(
+        datasets,
+        args.batch_size,
+        args.img_size,
+        rescale=not args.image_store,
+        eval_batch_size=args.eval_batch_size,
+    )
+    valid_set = valid_set.prefetch(tf.data.experimental.AUTOTUNE)
+    box_priors = load_box_prior(args.name, args.data_dir, args.img_size)
+    _, prior_grids, offset_grids, stride_grids = build_anchor_table(
+        [args.img_size], box_priors, args.img_size
+    )[tuple(args.img_size)]
+
+    set_precision(args.precision)
+    model = yolo_v3(
+        args.img_size + [3], labels, args.data_dir, fine_tunning=True, remat=args.remat
+    )
+    sink = build_metric_sink(
+        run, args.ckpt_dir, "evaluator", args.log_backends, args.log_every
+    )
+    if os.path.exists(f"{args.ckpt_dir}/eval_done.txt"):
+        os.remove(f"{args.ckpt_dir}/eval_done.txt")
+
+    eval_pool = build_eval_pool(args.eval_workers)
+    best_mean_ap = 0.0
+    step = 0
+    ckpt_path = None
+    train_done = lambda: os.path.exists(f"{args.ckpt_dir}/train_done.txt")
+    while True:
+        for ckpt_path in tf.train.checkpoints_iterator(
+            args.ckpt_dir, timeout=60, timeout_fn=train_done
+        ):
+            step = load_ckpt_weights(model, ckpt_path, use_ema=args.ema_decay > 0)
+            aps = validation(
+                valid_set,
+                valid_num,
+                offset_grids,
+                prior_grids,
+                stride_grids,
+                args.img_size,
+                model,
+                labels,
+                tf.distribute.get_strategy(),
+                args.map_method,
+                eval_pool,
+            )
+            sink.log(step, build_ap_metrics(aps, "validation/mAP"))
+            if aps["all"] > best_mean_ap:
+                best_mean_ap = aps["all"]
+                model.save_weights(f"{args.ckpt_dir}/best_weights.h5")
+        if tf.train.latest_checkpoint(args.ckpt_dir) == ckpt_path:
+            break
+
+    if eval_pool is not None:
+        eval_pool.shutdown()
+    sink.close(step)
+    with open(f"{args.ckpt_dir}/eval_done.txt", "w") as f:
+        f.write(f"{step} {best_mean_ap}")
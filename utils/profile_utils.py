@@ -0,0 +1,93 @@
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+class StageProfiler:
+    def __init__(
+        self, enabled=False, log_path=None, profile_steps=None, trace_dir=None
+    ):
+        self.enabled = enabled
+        self.log_path = log_path
+        self.profile_steps = profile_steps
+        self.trace_dir = trace_dir
+        self.tracing = False
+        self.times = defaultdict(list)
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start_time = time.perf_counter()
+        yield
+        self.times[name].append(time.perf_counter() - start_time)
+
+    def wait(self, strategy, values):
+        if self.enabled:
+            for value in tf.nest.flatten(values):
+                for local_value in strategy.experimental_local_results(value):
+                    tf.reduce_sum(tf.cast(local_value, dtype=tf.float32)).numpy()
+
+        return values
+
+    def trace(self, step):
+        if self.profile_steps is None:
+            return
+        start_step, stop_step = self.profile_steps
+        if not self.tracing and start_step <= step < stop_step:
+            tf.profiler.experimental.start(self.trace_dir)
+            self.tracing = True
+        elif self.tracing and step >= stop_step:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+
+    def summary(self, epoch):
+        if not self.enabled or not self.times:
+            return
+        step_time = sum(sum(times) for times in self.times.values())
+        stages = {}
+        for name, times in self.times.items():
+            times = np.asarray(times) * 1000
+            counts, edges = np.histogram(
+                times, bins=np.geomspace(max(times.min(), 1e-3), times.max() + 1e-3, 11)
+            )
+            stages[name] = {
+                "count": len(times),
+                "total_ms": float(times.sum()),
+                "mean_ms": float(times.mean()),
+                "p50_ms": float(np.percentile(times, 50)),
+                "p90_ms": float(np.percentile(times, 90)),
+                "p99_ms": float(np.percentile(times, 99)),
+                "hist_counts": counts.tolist(),
+                "hist_edges_ms": edges.tolist(),
+            }
+        input_wait_ratio = sum(self.times["input"]) / step_time if step_time else 0.0
+        record = {
+            "epoch": epoch,
+            "input_wait_ratio": input_wait_ratio,
+            "stages": stages,
+        }
+
+        print(
+            f"{'stage':>18} | {'count':>7} | {'mean ms':>9} | {'p50 ms':>9} | {'p90 ms':>9} | {'p99 ms':>9} | {'total s':>8}"
+        )
+        for name, stat in stages.items():
+            print(
+                f"{name:>18} | {stat['count']:>7} | {stat['mean_ms']:>9.2f} | {stat['p50_ms']:>9.2f} | "
+                f"{stat['p90_ms']:>9.2f} | {stat['p99_ms']:>9.2f} | {stat['total_ms'] / 1000:>8.2f}"
+            )
+        print(f"{'input wait ratio':>18} | {input_wait_ratio:.3f}")
+
+        if self.log_path is not None:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        self.times.clear()
+
+    def close(self):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
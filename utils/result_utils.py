@@ -1,7 +1,21 @@
+import queue
+import threading
+import multiprocessing
 import numpy as np
 import tensorflow as tf
 from PIL import ImageDraw
-from .bbox_utils import calculate_iou
+from concurrent.futures import ProcessPoolExecutor
+
+AREA_RANGES = {
+    "all": (0.0, 1e5**2),
+    "small": (0.0, 32.0**2),
+    "medium": (32.0**2, 96.0**2),
+    "large": (96.0**2, 1e5**2),
+}
+
+INTERP_POINTS = {"11point": 11, "101point": 101}
+
+MAP_INTERPOLATIONS = {"voc07": "11point", "voc12": "continuous", "coco": "101point"}
 
 
 def draw_output(
@@ -11,7 +25,7 @@ def draw_output(
     final_scores,
     labels,
 ):
-    image = tf.squeeze(image, axis=0)
+    image = image[0]
     image = tf.keras.preprocessing.image.array_to_img(image)
     width, height = image.size
     draw = ImageDraw.Draw(image)
@@ -41,89 +55,348 @@ def draw_output(
     return image
 
 
-def calculate_pr(final_bbox, gt_box, mAP_threshold):
-    bbox_num = tf.shape(final_bbox)[1].numpy()
-    gt_num = tf.shape(gt_box)[1].numpy()
+def calculate_iou_matrix(bboxes, gt_boxes):
+    bbox_area = calculate_area(bboxes)
+    gt_area = calculate_area(gt_boxes)
 
-    true_pos = tf.Variable(tf.zeros(bbox_num))
-    for i in range(bbox_num):
-        bbox = tf.split(final_bbox, bbox_num, axis=1)[i]
+    y_top = np.maximum(bboxes[:, None, 0], gt_boxes[None, :, 0])
+    x_top = np.maximum(bboxes[:, None, 1], gt_boxes[None, :, 1])
+    y_bottom = np.minimum(bboxes[:, None, 2], gt_boxes[None, :, 2])
+    x_bottom = np.minimum(bboxes[:, None, 3], gt_boxes[None, :, 3])
+    intersection_area = np.maximum(y_bottom - y_top, 0) * np.maximum(
+        x_bottom - x_top, 0
+    )
+    union_area = bbox_area[:, None] + gt_area[None, :] - intersection_area
 
-        iou = calculate_iou(bbox, gt_box)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return intersection_area / union_area
 
-        best_iou = tf.reduce_max(iou, axis=1)
-        pos_num = tf.cast(tf.greater(best_iou, mAP_threshold), dtype=tf.float32)
-        if tf.reduce_sum(pos_num) >= 1:
-            gt_box = gt_box * tf.expand_dims(
-                tf.cast(1 - pos_num, dtype=tf.float32), axis=-1
-            )
-            true_pos = tf.tensor_scatter_nd_update(true_pos, [[i]], [1])
-    false_pos = 1.0 - true_pos
-    true_pos = tf.math.cumsum(true_pos)
-    false_pos = tf.math.cumsum(false_pos)
 
-    recall = true_pos / gt_num
-    precision = tf.math.divide(true_pos, true_pos + false_pos)
+def calculate_pr(true_pos, false_pos, gt_num, dtype=np.float32, eps=0.0):
+    true_pos = np.cumsum(true_pos, axis=-1, dtype=dtype)
+    false_pos = np.cumsum(false_pos, axis=-1, dtype=dtype)
+
+    recall = true_pos / dtype(gt_num)
+    precision = true_pos / (true_pos + false_pos + eps)
 
     return precision, recall
 
 
-def calculate_ap_per_class(recall, precision):
-    interp = tf.constant([i / 10 for i in range(0, 11)])
-    AP = tf.reduce_max(
-        [tf.where(interp <= recall[i], precision[i], 0.0) for i in range(len(recall))],
-        axis=0,
-    )
-    AP = tf.reduce_sum(AP) / 11
+def calculate_ap_per_class(recall, precision, method="11point"):
+    dtype = np.float64 if np.asarray(recall).dtype == np.float64 else np.float32
+    recall = np.asarray(recall, dtype=dtype)
+    precision = np.asarray(precision, dtype=dtype)
+    envelope = np.maximum.accumulate(precision[::-1])[::-1]
+    if method == "continuous":
+        recall_steps = np.diff(recall, prepend=dtype(0.0))
+        return float(np.sum(recall_steps * envelope))
 
-    return AP
+    recall_points = np.linspace(0.0, 1.0, INTERP_POINTS[method], dtype=dtype)
+    indices = np.searchsorted(recall, recall_points, side="left")
+    interp = np.append(envelope, dtype(0.0))[indices]
 
+    return float(np.mean(interp))
 
-def calculate_ap_const(
-    final_bboxes, final_labels, gt_boxes, gt_labels, labels, mAP_threshold=0.5
-):
-    AP = []
-    for c in range(len(labels)):
-        if tf.math.reduce_any(final_labels == c) or tf.math.reduce_any(gt_labels == c):
-            final_bbox = tf.expand_dims(final_bboxes[final_labels == c], axis=0)
-            gt_box = tf.expand_dims(gt_boxes[gt_labels == c], axis=0)
-
-            if final_bbox.shape[1] == 0 or gt_box.shape[1] == 0:
-                ap = tf.constant(0.0)
-            else:
-                precision, recall = calculate_pr(final_bbox, gt_box, mAP_threshold)
-                ap = calculate_ap_per_class(recall, precision)
-            AP.append(ap)
-    if AP == []:
-        AP = 1.0
-    else:
-        AP = tf.reduce_mean(AP)
-
-    return AP
-
-
-def calculate_ap(final_bboxes, final_labels, gt_boxes, gt_labels, labels):
-    mAP_threshold_lst = np.arange(0.5, 1.0, 0.05)
-    APs = []
-    for mAP_threshold in mAP_threshold_lst:
-        AP = []
-        for c in range(len(labels)):
-            if tf.math.reduce_any(final_labels == c) or tf.math.reduce_any(
-                gt_labels == c
-            ):
-                final_bbox = tf.expand_dims(final_bboxes[final_labels == c], axis=0)
-                gt_box = tf.expand_dims(gt_boxes[gt_labels == c], axis=0)
-
-                if final_bbox.shape[1] == 0 or gt_box.shape[1] == 0:
-                    ap = tf.constant(0.0)
-                else:
-                    precision, recall = calculate_pr(final_bbox, gt_box, mAP_threshold)
-                    ap = calculate_ap_per_class(recall, precision)
-                AP.append(ap)
-        if AP == []:
-            AP = 1.0
+
+def calculate_area(bboxes):
+    return (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+
+
+class MeanAveragePrecision:
+    def __init__(self, labels_num, method="voc07", pool=None, chunk_size=64):
+        self.labels_num = labels_num
+        self.method = method
+        if method == "coco":
+            self.mAP_thresholds = np.linspace(0.5, 0.95, 10)
+            self.area_ranges = AREA_RANGES
+        else:
+            self.mAP_thresholds = np.array([0.5])
+            self.area_ranges = {"all": AREA_RANGES["all"]}
+        self.area_known = True
+        self.scores = [[] for _ in range(labels_num)]
+        self.true_pos = [[] for _ in range(labels_num)]
+        self.det_ignore = [[] for _ in range(labels_num)]
+        self.gt_nums = np.zeros((len(self.area_ranges), labels_num), dtype=np.int64)
+        self.chunk_size = chunk_size
+        self.pending = []
+        self.futures = []
+        self.pool = pool
+
+    def update(self, detections, ground_truth, image_shape=None, gt_areas=None):
+        final_bboxes, final_labels, final_scores = [
+            np.asarray(detection) for detection in detections
+        ]
+        gt_boxes, gt_labels = [np.asarray(gt) for gt in ground_truth]
+        final_bboxes = np.reshape(final_bboxes, (-1, 4))
+        final_labels = np.reshape(final_labels, (-1,)).astype(np.int64)
+        final_scores = np.reshape(final_scores, (-1,))
+        gt_boxes = np.reshape(gt_boxes, (-1, 4))
+        gt_labels = np.reshape(gt_labels, (-1,)).astype(np.int64)
+        if image_shape is None or gt_areas is None:
+            self.area_known = False
+            bbox_areas = np.zeros(len(final_bboxes))
+            gt_areas = np.zeros(len(gt_boxes))
         else:
-            AP = tf.reduce_mean(AP)
-        APs.append(AP)
+            image_height, image_width = np.asarray(image_shape, dtype=np.float64)
+            bbox_areas = calculate_area(final_bboxes.astype(np.float64))
+            bbox_areas = bbox_areas * image_height * image_width
+            gt_areas = np.reshape(gt_areas, (-1,))[: len(gt_boxes)]
+        gt_boxes = gt_boxes[gt_labels >= 0]
+        gt_areas = gt_areas[gt_labels >= 0]
+        gt_labels = gt_labels[gt_labels >= 0]
+
+        valid = final_scores > 0
+        sample = (
+            final_bboxes[valid],
+            final_labels[valid],
+            final_scores[valid],
+            bbox_areas[valid],
+            gt_boxes,
+            gt_labels,
+            gt_areas,
+        )
+        if self.pool is None:
+            self.merge(
+                match_samples(
+                    [sample], self.method, self.mAP_thresholds, self.area_ranges
+                )
+            )
+            return
+        self.pending.append(sample)
+        if len(self.pending) >= self.chunk_size:
+            self.submit()
+
+    def submit(self):
+        if self.pending:
+            self.futures.append(
+                self.pool.submit(
+                    match_samples,
+                    self.pending,
+                    self.method,
+                    self.mAP_thresholds,
+                    self.area_ranges,
+                )
+            )
+            self.pending = []
+
+    def merge(self, matches):
+        for c, gt_nums, scores, true_pos, det_ignore in matches:
+            self.gt_nums[:, c] += gt_nums
+            if len(scores):
+                self.scores[c].append(scores)
+                self.true_pos[c].append(true_pos)
+                self.det_ignore[c].append(det_ignore)
+
+    def update_batch(self, detections, ground_truth, image_shapes=None, gt_areas=None):
+        final_bboxes, final_labels, final_scores, valid_detections = [
+            np.asarray(detection) for detection in detections
+        ]
+        gt_boxes, gt_labels = [np.asarray(gt) for gt in ground_truth]
+        for i, valid_num in enumerate(valid_detections):
+            self.update(
+                (
+                    final_bboxes[i, :valid_num],
+                    final_labels[i, :valid_num],
+                    final_scores[i, :valid_num],
+                ),
+                (gt_boxes[i], gt_labels[i]),
+                None if image_shapes is None else image_shapes[i],
+                None if gt_areas is None else gt_areas[i],
+            )
+
+    def result(self):
+        if self.pool is not None:
+            self.submit()
+            for future in self.futures:
+                self.merge(future.result())
+            self.futures = []
+
+        if self.method == "coco":
+            dtype, eps = np.float64, np.spacing(1)
+        else:
+            dtype, eps = np.float32, 0.0
+        aps = {area: [] for area in self.area_ranges}
+        for c in range(self.labels_num):
+            if self.scores[c]:
+                scores = np.concatenate(self.scores[c])
+                order = np.argsort(-scores, kind="mergesort")
+                true_pos = np.concatenate(self.true_pos[c], axis=-1)[..., order]
+                det_ignore = np.concatenate(self.det_ignore[c], axis=-1)[..., order]
+            for a, area in enumerate(self.area_ranges):
+                if self.gt_nums[a, c] == 0:
+                    continue
+                if not self.scores[c]:
+                    aps[area].append(0.0)
+                    continue
+                precision, recall = calculate_pr(
+                    true_pos[a],
+                    ~true_pos[a] & ~det_ignore[a],
+                    self.gt_nums[a, c],
+                    dtype,
+                    eps,
+                )
+                aps[area].append(
+                    np.mean(
+                        [
+                            calculate_ap_per_class(
+                                recall[t], precision[t], MAP_INTERPOLATIONS[self.method]
+                            )
+                            for t in range(len(self.mAP_thresholds))
+                        ]
+                    )
+                )
+
+        results = {"all": float(np.mean(aps["all"])) if aps["all"] else 0.0}
+        if self.area_known:
+            results.update({area: float(np.mean(ap)) for area, ap in aps.items() if ap})
+
+        return results
+
+
+def match_samples(samples, method, mAP_thresholds, area_ranges):
+    matches = []
+    for sample in samples:
+        final_bboxes, final_labels, final_scores, bbox_areas = sample[:4]
+        gt_boxes, gt_labels, gt_areas = sample[4:]
+        for c in np.union1d(final_labels, gt_labels):
+            final_bbox = final_bboxes[final_labels == c]
+            final_score = final_scores[final_labels == c]
+            bbox_area = bbox_areas[final_labels == c]
+            gt_box = gt_boxes[gt_labels == c]
+            gt_area = gt_areas[gt_labels == c]
+            gt_ignore = np.stack(
+                [
+                    (gt_area < min_area) | (gt_area > max_area)
+                    for min_area, max_area in area_ranges.values()
+                ]
+            )
+            gt_nums = np.sum(~gt_ignore, axis=-1)
+            if len(final_bbox) == 0:
+                matches.append((c, gt_nums, final_score, None, None))
+                continue
+            order = np.argsort(-final_score, kind="mergesort")
+            if method == "coco":
+                order = order[:100]
+                iou = calculate_iou_matrix(
+                    final_bbox[order].astype(np.float64), gt_box.astype(np.float64)
+                )
+                true_pos, det_ignore = [], []
+                for (min_area, max_area), ignore in zip(
+                    area_ranges.values(), gt_ignore
+                ):
+                    matched, matched_ignore = match_coco_gt(iou, mAP_thresholds, ignore)
+                    out_of_range = (bbox_area[order] < min_area) | (
+                        bbox_area[order] > max_area
+                    )
+                    true_pos.append(matched & ~matched_ignore)
+                    det_ignore.append(matched_ignore | (~matched & out_of_range))
+                true_pos = np.stack(true_pos)
+                det_ignore = np.stack(det_ignore)
+            else:
+                iou = calculate_iou_matrix(final_bbox[order], gt_box)
+                true_pos = match_best_gt(iou, mAP_thresholds)[None]
+                det_ignore = np.zeros_like(true_pos)
+            matches.append((c, gt_nums, final_score[order], true_pos, det_ignore))
+
+    return matches
+
+
+def build_ap_metrics(aps, prefix):
+    return {
+        prefix if area == "all" else f"{prefix}_{area}": ap for area, ap in aps.items()
+    }
+
+
+def format_aps(aps):
+    return " | ".join(
+        "{} {:.4f}".format(key, mean_ap)
+        for key, mean_ap in build_ap_metrics(aps, "Mean_Average_Precision").items()
+    )
+
+
+def build_eval_pool(workers):
+    if workers <= 1:
+        return None
+
+    return ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("forkserver")
+    )
+
+
+class MetricConsumer:
+    def __init__(self, metric, maxsize=16):
+        self.metric = metric
+        self.error = None
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self.consume, daemon=True)
+        self.thread.start()
+
+    def update_batch(self, *args):
+        self.raise_error()
+        self.queue.put(args)
+
+    def consume(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.metric.update_batch(*item)
+            except Exception as error:
+                self.error = error
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def result(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+        return self.metric.result()
+
+
+def match_best_gt(iou, mAP_thresholds):
+    # each detection, in score order, takes its best still available gt; unlike
+    # the old loop it leaves other gts above the threshold to later detections
+    mAP_thresholds = np.reshape(mAP_thresholds, (-1, 1))
+    threshold_indices = np.arange(len(mAP_thresholds))
+    available = np.ones((len(mAP_thresholds), iou.shape[1]), dtype=bool)
+    true_pos = np.zeros((len(mAP_thresholds), iou.shape[0]), dtype=bool)
+    if iou.shape[1] == 0:
+        return true_pos
+    for i in range(iou.shape[0]):
+        candidate = np.where(available & (iou[i] > mAP_thresholds), iou[i], -1.0)
+        best_gt = np.argmax(candidate, axis=-1)
+        matched = candidate[threshold_indices, best_gt] > 0
+        available[threshold_indices[matched], best_gt[matched]] = False
+        true_pos[:, i] = matched
+
+    return true_pos
+
+
+def match_coco_gt(iou, mAP_thresholds, gt_ignore):
+    # like pycocotools, a detection prefers regular gts over ignored ones and
+    # takes the highest iou, ties going to the later gt
+    mAP_thresholds = np.reshape(np.minimum(mAP_thresholds, 1 - 1e-10), (-1, 1))
+    threshold_indices = np.arange(len(mAP_thresholds))
+    available = np.ones((len(mAP_thresholds), iou.shape[1]), dtype=bool)
+    matched = np.zeros((len(mAP_thresholds), iou.shape[0]), dtype=bool)
+    matched_ignore = np.zeros_like(matched)
+    if iou.shape[1] == 0:
+        return matched, matched_ignore
+    for i in range(iou.shape[0]):
+        candidate = available & (iou[i] >= mAP_thresholds)
+        regular = candidate & ~gt_ignore
+        candidate = np.where(regular.any(axis=-1, keepdims=True), regular, candidate)
+        candidate_iou = np.where(candidate, iou[i], -1.0)[:, ::-1]
+        best_gt = iou.shape[1] - 1 - np.argmax(candidate_iou, axis=-1)
+        is_matched = candidate[threshold_indices, best_gt]
+        available[threshold_indices[is_matched], best_gt[is_matched]] = False
+        matched[:, i] = is_matched
+        matched_ignore[:, i] = is_matched & gt_ignore[best_gt]
 
-    return tf.reduce_mean(APs)
+    return matched, matched_ignore
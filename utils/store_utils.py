@@ -0,0 +1,141 @@
+import os
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+from tqdm import tqdm
+from .bbox_utils import extract_gt_areas
+
+
+def load_image_store(datasets, name, data_dir, img_size, data_nums):
+    store_dir = build_store_dir(name, data_dir, img_size)
+    if not (
+        os.path.exists(f"{store_dir}/done.txt")
+        and os.path.exists(f"{store_dir}/test_shapes.npy")
+    ):
+        build_image_store(datasets, store_dir, img_size, data_nums)
+
+    return tuple(
+        read_image_store(store_dir, split, img_size)
+        for split in ("train", "validation", "test")
+    )
+
+
+def build_store_dir(name, data_dir, img_size):
+    return f"{data_dir}/data_chkr/{''.join(char for char in name if char.isalnum())}_store_{img_size[0]}x{img_size[1]}"
+
+
+def build_image_store(datasets, store_dir, img_size, data_nums):
+    os.makedirs(store_dir, exist_ok=True)
+    for dataset, split, data_num in zip(
+        datasets, ("train", "validation", "test"), data_nums
+    ):
+        write_split(dataset, store_dir, split, img_size, data_num)
+
+    with open(f"{store_dir}/done.txt", "w") as f:
+        f.write(" ".join(str(data_num) for data_num in data_nums))
+
+
+def write_split(dataset, store_dir, split, img_size, data_num):
+    images = np.lib.format.open_memmap(
+        f"{store_dir}/{split}_images.npy",
+        mode="w+",
+        dtype=np.uint8,
+        shape=(data_num, img_size[0], img_size[1], 3),
+    )
+    dataset = dataset.map(
+        lambda x: export_store_sample(x, img_size),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+    ).prefetch(tf.data.experimental.AUTOTUNE)
+
+    gt_boxes, gt_labels, is_diff, gt_areas, offsets = [], [], [], [], [0]
+    image_shapes = []
+    progress = tqdm(tfds.as_numpy(dataset.take(data_num)), total=data_num)
+    progress.set_description(f"Exporting {split} images to store")
+    for index, (image, boxes, labels, diff, areas, shape) in enumerate(progress):
+        images[index] = image
+        gt_boxes.append(boxes)
+        gt_labels.append(labels)
+        is_diff.append(diff)
+        gt_areas.append(areas)
+        image_shapes.append(shape)
+        offsets.append(offsets[-1] + len(labels))
+    images.flush()
+
+    np.save(
+        f"{store_dir}/{split}_boxes.npy",
+        np.concatenate(gt_boxes).astype(np.float32).reshape(-1, 4),
+    )
+    np.save(f"{store_dir}/{split}_labels.npy", np.concatenate(gt_labels))
+    np.save(f"{store_dir}/{split}_is_diff.npy", np.concatenate(is_diff))
+    np.save(f"{store_dir}/{split}_areas.npy", np.concatenate(gt_areas))
+    np.save(f"{store_dir}/{split}_shapes.npy", np.stack(image_shapes))
+    np.save(f"{store_dir}/{split}_offsets.npy", np.asarray(offsets, dtype=np.int64))
+
+
+def export_store_sample(sample, img_size):
+    image = sample["image"]
+    if image.dtype == tf.string:
+        image = tf.io.decode_image(image, channels=3, expand_animations=False)
+    image_shape = tf.shape(image)[:2]
+    gt_areas = extract_gt_areas(
+        sample["objects"], sample["objects"]["bbox"], image_shape
+    )
+    image = tf.image.resize(image, img_size)
+    image = tf.cast(tf.round(tf.clip_by_value(image, 0.0, 255.0)), dtype=tf.uint8)
+    if "is_crowd" in sample["objects"]:
+        is_diff = sample["objects"]["is_crowd"]
+    else:
+        is_diff = sample["objects"]["is_difficult"]
+
+    return (
+        image,
+        sample["objects"]["bbox"],
+        sample["objects"]["label"],
+        is_diff,
+        gt_areas,
+        image_shape,
+    )
+
+
+def read_image_store(store_dir, split, img_size):
+    images_path = f"{store_dir}/{split}_images.npy"
+    header_bytes = np.load(images_path, mmap_mode="r").offset
+    gt_boxes = np.load(f"{store_dir}/{split}_boxes.npy")
+    gt_labels = np.load(f"{store_dir}/{split}_labels.npy")
+    is_diff = np.load(f"{store_dir}/{split}_is_diff.npy")
+    gt_areas = np.load(f"{store_dir}/{split}_areas.npy")
+    image_shapes = np.load(f"{store_dir}/{split}_shapes.npy")
+    offsets = np.load(f"{store_dir}/{split}_offsets.npy")
+
+    image_set = tf.data.FixedLengthRecordDataset(
+        images_path,
+        record_bytes=img_size[0] * img_size[1] * 3,
+        header_bytes=header_bytes,
+    )
+    annotation_set = tf.data.Dataset.from_tensor_slices(
+        tuple(
+            tf.RaggedTensor.from_row_splits(values, offsets)
+            for values in (gt_boxes, gt_labels, is_diff, gt_areas)
+        )
+        + (image_shapes,)
+    )
+
+    def to_sample(record, annotation):
+        image = tf.reshape(tf.io.decode_raw(record, tf.uint8), list(img_size) + [3])
+        boxes, labels, diff, areas, image_shape = annotation
+        return {
+            "image": image,
+            "image_shape": image_shape,
+            "objects": {
+                "bbox": boxes,
+                "label": labels,
+                "is_difficult": diff,
+                "area": areas,
+            },
+        }
+
+    store_set = tf.data.Dataset.zip((image_set, annotation_set)).map(
+        to_sample, num_parallel_calls=tf.data.experimental.AUTOTUNE
+    )
+
+    return store_set
@@ -51,7 +51,7 @@ def build_true_reg(
 def build_true_obj(scatter_bbox_indices, valid_indices, iou_map):
     pos_mask = tf.scatter_nd(
         indices=scatter_bbox_indices,
-        updates=tf.fill(tf.shape(valid_indices)[0], True),
+        updates=tf.fill(tf.shape(valid_indices)[:1], True),
         shape=tf.shape(iou_map)[:2],
     )
     true_obj = tf.where(